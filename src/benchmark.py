@@ -0,0 +1,302 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+from capture import RecordedSource, open_source
+from buffers import BufferPool
+from valu_vision import Template, TemplateTracker, hsv_table
+
+# Run from src/ like the other scripts:
+#   python benchmark.py --output before.json
+#   python benchmark.py --source ../recordings/line1.avi --frames 100 --output after.json
+
+RESOLUTIONS = ((320, 240), (640, 480), (1280, 720), (1920, 1080))
+CONTOURS = (10, 100, 1000)
+BLUR_MODES = (0, 1, 2, 3)
+BINARY_METHODS = (0, 1, 2)
+# Hue ranges for --color, the second wraps around red
+HUE_RANGES = ((20, 60), (230, 20))
+STAGES = ("read", "gate", "template", "blur", "color", "binary", "contours", "filters", "matching", "results", "total")
+
+
+class FrameList(RecordedSource):
+    # Frames held in memory so decoding doesn't show up in the timings
+    def __init__(self, frames):
+        self.frames_list = frames
+        RecordedSource.__init__(self, 30.0, realtime=False, loop=True)
+
+    def next_frame(self, image=None):
+        if self.index >= len(self.frames_list):
+            return False, None
+        return True, self.frames_list[self.index]
+
+    def release(self):
+        pass
+
+
+class BenchApp:
+    # What TemplateTracker needs from App, without MQTT or a window
+    def __init__(self):
+        self.settings = {"camera_number": 0, "change_gate": 0, "roi_mode": 0, "headless": 1}
+        self.state = "tracking"
+
+
+def synthetic_frames(template, size, contours, count=4, seed=0):
+    # Random blobs in random colors around a few copies of the template image
+    rng = np.random.default_rng(seed)
+    width, height = size
+    th, tw = template.img.shape[:2]
+    frames = list()
+    for _ in range(count):
+        img = np.full((height, width, 3), 30, np.uint8)
+        img += rng.integers(0, 8, img.shape, dtype=np.uint8)
+        for _ in range(contours):
+            x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+            color = tuple(int(c) for c in rng.integers(60, 255, 3))
+            r = int(rng.integers(2, max(3, min(width, height) // 30)))
+            if rng.random() < 0.5:
+                cv2.circle(img, (x, y), r, color, -1)
+            else:
+                cv2.rectangle(img, (x, y), (x + r, y + 2 * r), color, -1)
+        if tw < width and th < height:
+            for _ in range(2):
+                x, y = int(rng.integers(0, width - tw)), int(rng.integers(0, height - th))
+                img[y:y + th, x:x + tw] = template.img
+        frames.append(img)
+    return frames
+
+
+def quiet_frames(size, count=4, boxes=8, seed=0):
+    # Solid rectangles on black, each contour is four points. Contour
+    # geometry allocates per point, these frames keep it far below one image.
+    rng = np.random.default_rng(seed)
+    width, height = size
+    frames = list()
+    for _ in range(count):
+        img = np.zeros((height, width, 3), np.uint8)
+        for _ in range(boxes):
+            x, y = int(rng.integers(0, width * 3 // 4)), int(rng.integers(0, height * 3 // 4))
+            w, h = int(rng.integers(4, width // 4)), int(rng.integers(4, height // 4))
+            color = tuple(int(c) for c in rng.integers(60, 255, 3))
+            cv2.rectangle(img, (x, y), (x + w, y + h), color, -1)
+        frames.append(img)
+    return frames
+
+
+def recorded_frames(path, size, count):
+    source = open_source({"source": path, "source_pacing": "fast"})
+    frames = list()
+    while len(frames) < count:
+        frame, _, _ = source.read_frame()
+        if frame is None:
+            break
+        if frame.shape[1::-1] != size:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        frames.append(frame.copy())
+    source.release()
+    return frames
+
+
+def run_case(template, frames, blur, binary, count, warmup):
+    template.config["Blur"] = blur
+    template.config["BinaryMethod"] = binary
+    tracker = TemplateTracker(BenchApp(), template, FrameList(frames))
+
+    # The first frame builds the template state, the warmup frames settle caches
+    for _ in range(warmup):
+        tracker.update()
+
+    samples = {stage: list() for stage in STAGES}
+    found = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        matches = tracker.update()
+        found += len(matches or [])
+        for stage in STAGES:
+            samples[stage].append(tracker.stage_times.get(stage, 0.0))
+    elapsed = time.perf_counter() - start
+
+    stages = dict()
+    for stage, values in samples.items():
+        values = np.array(values) * 1000
+        stages[stage] = {"mean_ms": float(values.mean()), "median_ms": float(np.median(values)),
+                         "max_ms": float(values.max())}
+    return {"fps": count / elapsed, "contours_found": len(tracker.contours),
+            "matches_per_frame": found / count, "stages": stages}
+
+
+def alloc_check(template, size, count, warmup):
+    # Image buffers of steady-state frames come from TemplateTracker's
+    # BufferPool, allocated during the warmup. On quiet_frames everything
+    # else a frame allocates, held or freed before update() returns, stays
+    # far below one plane, so a traced peak of a plane or more is an image
+    # allocated per frame.
+    frames = quiet_frames(size)
+    plane = size[0] * size[1]
+    tracker = TemplateTracker(BenchApp(), template, FrameList(frames))
+    for _ in range(warmup):
+        tracker.update()
+    pool = tracker.buffers.allocated
+
+    tracemalloc.start()
+    worst, largest, where = 0, 0, None
+    for _ in range(count):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        tracker.update()
+        worst = max(worst, tracemalloc.get_traced_memory()[1] - before)
+        # Single blocks, statistics() would add up the blocks of one line
+        for trace in tracemalloc.take_snapshot().traces:
+            if trace.size > largest:
+                largest, where = trace.size, str(trace.traceback[0])
+    tracemalloc.stop()
+
+    pool = tracker.buffers.allocated - pool
+    return {"peak_bytes_per_frame": worst, "largest_block": largest, "largest_block_at": where,
+            "pool_allocations": pool, "plane_bytes": plane, "ok": worst < plane and not pool}
+
+
+def color_case(template, frames, hue, count):
+    # Color gate alone and with the band thresholds of BinaryMethod 1, for
+    # the BGR ranges of ColorSpace 0 and the HSV ranges of ColorSpace 1.
+    # Restores the config, later cases run with the template's own colors.
+    saved = dict(template.config)
+    try:
+        return time_colors(template, frames, hue, count)
+    finally:
+        template.config = saved
+
+
+def time_colors(template, frames, hue, count):
+    template.config.update(HueLower=hue[0], HueUpper=hue[1], SaturationLower=40, SaturationUpper=255,
+                           ValueLower=40, ValueUpper=255, BinaryMethod=1)
+    tracker = TemplateTracker(BenchApp(), template, FrameList(frames))
+    buffers = BufferPool()
+
+    def color_space(value, gate):
+        def run(img):
+            template.config["ColorSpace"] = value
+            return gate(img)
+        return run
+
+    start = time.perf_counter()
+    hsv_table(template.get_hsv_lower(), template.get_hsv_upper(), tracker.band())
+    build = time.perf_counter() - start
+
+    mask = lambda img: tracker.range_mask(img, buffers)
+    band = lambda img: tracker.band_lookup(img, tracker.range_mask(img, buffers), buffers)
+    gates = {"bgr_in_range": color_space(0, mask),
+             "bgr_in_range_band": color_space(0, band),
+             "hsv_in_range": color_space(1, mask),
+             "hsv_in_range_band": color_space(1, band),
+             "hsv_table_band": color_space(1, lambda img: tracker.hsv_band_lookup(img, buffers))}
+    times = dict()
+    for name, gate in gates.items():
+        gate(frames[0])
+        start = time.perf_counter()
+        for i in range(count):
+            gate(frames[i % len(frames)])
+        times[name] = (time.perf_counter() - start) / count * 1000
+
+    # Both write into the same binary buffer
+    exact = all(np.array_equal(gates["hsv_table_band"](img).copy(), gates["hsv_in_range_band"](img))
+                for img in frames)
+    return {"hue": list(hue), "table_build_ms": build * 1000, "exact": exact, "mean_ms": times}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage timings of TemplateTracker.update()")
+    parser.add_argument("--template", default="../templates/lid", help="template name without extension")
+    parser.add_argument("--source", action="append", default=list(), help="video file or image directory, repeatable")
+    parser.add_argument("--resolutions", default=",".join(str(w)+"x"+str(h) for w, h in RESOLUTIONS))
+    parser.add_argument("--contours", default=",".join(str(c) for c in CONTOURS), help="blobs per synthetic frame")
+    parser.add_argument("--blur", default=",".join(str(b) for b in BLUR_MODES))
+    parser.add_argument("--binary", default=",".join(str(b) for b in BINARY_METHODS))
+    parser.add_argument("--frames", type=int, default=30, help="timed frames per case")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--no-synthetic", action="store_true")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--color", action="store_true",
+                        help="also time the color gates against each other")
+    parser.add_argument("--alloc-check", action="store_true",
+                        help="fail if steady-state frames allocate image buffers")
+    args = parser.parse_args(argv)
+
+    resolutions = [tuple(int(v) for v in r.split("x")) for r in args.resolutions.split(",")]
+    contour_counts = [int(c) for c in args.contours.split(",")]
+    blur_modes = [int(b) for b in args.blur.split(",")]
+    binary_methods = [int(b) for b in args.binary.split(",")]
+
+    template = Template()
+    template.load(args.template)
+
+    inputs = list()
+    for size in resolutions:
+        if not args.no_synthetic:
+            for contours in contour_counts:
+                inputs.append(({"kind": "synthetic", "contours": contours}, size,
+                               synthetic_frames(template, size, contours)))
+        for path in args.source:
+            inputs.append(({"kind": "recorded", "source": path}, size,
+                           recorded_frames(path, size, args.frames + args.warmup)))
+
+    results = list()
+    colors = list()
+    for info, size, frames in inputs:
+        if not frames:
+            print("No frames in", info, file=sys.stderr)
+            continue
+        for blur in blur_modes:
+            for binary in binary_methods:
+                case = dict(info, width=size[0], height=size[1], blur=blur, binary_method=binary,
+                            color_space=template.config["ColorSpace"],
+                            hue=[template.config["HueLower"], template.config["HueUpper"]])
+                case.update(run_case(template, frames, blur, binary, args.frames, args.warmup))
+                if args.alloc_check:
+                    case["alloc"] = alloc_check(template, size, args.frames, args.warmup)
+                results.append(case)
+                print(info["kind"], size, "blur", blur, "binary", binary, "%.1f fps" % case["fps"], file=sys.stderr)
+        if args.color:
+            for hue in HUE_RANGES:
+                case = dict(info, width=size[0], height=size[1])
+                case.update(color_case(template, frames, hue, args.frames))
+                colors.append(case)
+                print(info["kind"], size, "hue", hue, " ".join("%s %.2f ms" % t for t in case["mean_ms"].items()),
+                      file=sys.stderr)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "template": args.template,
+        "frames": args.frames,
+        "environment": {"python": platform.python_version(), "opencv": cv2.__version__,
+                        "numpy": np.__version__, "machine": platform.machine(),
+                        "cpus": os.cpu_count(), "cv_threads": cv2.getNumThreads()},
+        "results": results,
+        }
+    if args.color:
+        report["color"] = colors
+
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print("Wrote", len(results), "results to", args.output, file=sys.stderr)
+
+    if args.alloc_check:
+        failed = [r for r in results if not r["alloc"]["ok"]]
+        for r in failed:
+            print("Allocates", r["alloc"]["peak_bytes_per_frame"], "bytes per frame, largest block held",
+                  r["alloc"]["largest_block"], "bytes at", str(r["alloc"]["largest_block_at"])+",",
+                  r["alloc"]["pool_allocations"], "new buffers:", r["kind"],
+                  r["width"], r["height"], "blur", r["blur"], "binary", r["binary_method"], file=sys.stderr)
+        if failed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
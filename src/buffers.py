@@ -0,0 +1,32 @@
+import numpy as np
+
+UINT8 = np.dtype(np.uint8)
+
+
+class BufferPool:
+    # Arrays reused from frame to frame as OpenCV dst= targets, keyed by role,
+    # shape and dtype. A buffer is only valid until its role is asked for
+    # again, so nothing kept across frames may come from here. Every role
+    # keeps its last few shapes, a region of interest changes size as the
+    # target moves.
+    def __init__(self, shapes_per_role=4):
+        self.buffers = dict()
+        self.shapes_per_role = shapes_per_role
+        self.allocated = 0
+
+    def get(self, role, shape, dtype=UINT8):
+        key = (role, shape, dtype)
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            same_role = [k for k in self.buffers if k[0] == role]
+            if len(same_role) >= self.shapes_per_role:
+                del self.buffers[same_role[0]]
+            buffer = self.buffers[key] = np.empty(shape, dtype)
+            self.allocated += 1
+        return buffer
+
+    def like(self, role, img):
+        return self.get(role, img.shape, img.dtype)
+
+    def stats(self):
+        return {"buffers": len(self.buffers), "allocated": self.allocated}
@@ -0,0 +1,278 @@
+import cv2
+import os
+import threading
+import time
+
+IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff")
+
+
+def open_source(settings):
+    # source setting: empty for the camera, else a video file or an image directory
+    path = settings.get("source")
+    if not path:
+        return open_camera(settings)
+
+    realtime = settings.get("source_pacing", "realtime") == "realtime"
+    loop = settings.get("source_loop", 0)
+    if os.path.isdir(path):
+        return ImageDirectorySource(path, settings.get("source_fps", 30), realtime, loop)
+    return VideoFileSource(path, realtime, loop)
+
+
+def open_camera(settings):
+    if settings.get("threaded_capture", 0):
+        return FrameGrabber(settings["camera_number"], settings.get("capture_buffers", 3))
+    return Camera(settings["camera_number"])
+
+
+class Camera:
+    # Synchronous capture, same interface as FrameGrabber
+    def __init__(self, camera_number):
+        self.cam = cv2.VideoCapture(camera_number)
+        self.ended = False
+        self.seq = 0
+        self.frame_seq = 0
+        self.frame_time = 0.0
+
+    def read(self, image=None):
+        ok, frame = self.cam.read(image)
+        if ok:
+            self.seq += 1
+            self.frame_seq = self.seq
+            self.frame_time = time.time()
+        return ok, frame
+
+    def read_frame(self, image=None):
+        ok, frame = self.read(image)
+        if not ok:
+            return None, 0.0, 0
+        return frame, self.frame_time, self.frame_seq
+
+    def isOpened(self):
+        return self.cam.isOpened()
+
+    def release(self):
+        self.cam.release()
+
+    def stats(self):
+        return {"frames": self.seq, "dropped": 0, "duplicates": 0}
+
+
+class FrameGrabber:
+    # Reads the camera on its own thread into a small ring of reusable buffers.
+    # The consumer always gets the newest frame; frames it never saw are counted
+    # as dropped, frames it sees twice as duplicates.
+    def __init__(self, camera_number, buffers=3):
+        self.cam = cv2.VideoCapture(camera_number)
+        # Keep the driver queue short, we want the newest frame, not the oldest
+        self.cam.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+        # Need one slot being written, one holding the latest frame and one
+        # held by the consumer
+        buffers = max(3, buffers)
+        self.buffers = [None] * buffers
+        self.stamps  = [0.0] * buffers
+        self.seqs    = [0] * buffers
+
+        self.ended  = False
+        self.latest = -1
+        self.held   = -1
+        self.seq    = 0
+        self.last_read = 0
+
+        self.frame_seq  = 0
+        self.frame_time = 0.0
+
+        self.dropped    = 0
+        self.duplicates = 0
+        self.failed     = 0
+
+        self.lock = threading.Lock()
+        self.new_frame = threading.Condition(self.lock)
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="FrameGrabber", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                slot = self.free_slot()
+
+            ok, frame = self.cam.read(self.buffers[slot])
+            stamp = time.time()
+            if not ok:
+                self.failed += 1
+                time.sleep(0.01)
+                continue
+
+            with self.lock:
+                # read() may hand back a new array if the frame size changed
+                self.buffers[slot] = frame
+                self.seq += 1
+                self.seqs[slot] = self.seq
+                self.stamps[slot] = stamp
+                if self.latest >= 0 and self.seqs[self.latest] > self.last_read:
+                    self.dropped += 1
+                self.latest = slot
+                self.new_frame.notify_all()
+
+    def free_slot(self):
+        for i in range(len(self.buffers)):
+            if i != self.latest and i != self.held:
+                return i
+
+    def read_frame(self, image=None, timeout=1.0):
+        # Wait for a frame newer than the last one read, else hand out the same
+        # one again. Frames already live in the reused ring buffers, image is
+        # only there for the same signature as the other sources.
+        with self.lock:
+            if self.latest < 0 or self.seqs[self.latest] <= self.last_read:
+                self.new_frame.wait(timeout)
+            if self.latest < 0:
+                return None, 0.0, 0
+
+            self.held = self.latest
+            seq = self.seqs[self.held]
+            if seq == self.last_read:
+                self.duplicates += 1
+            self.last_read = seq
+
+            self.frame_seq  = seq
+            self.frame_time = self.stamps[self.held]
+            return self.buffers[self.held], self.frame_time, seq
+
+    def read(self, image=None):
+        # Drop-in for cv2.VideoCapture.read(). The returned array stays valid
+        # until the next call, pass image to get a private copy.
+        frame, _, _ = self.read_frame()
+        if frame is None:
+            return False, None
+        if image is not None and image.shape == frame.shape:
+            image[...] = frame
+            return True, image
+        return True, frame
+
+    def isOpened(self):
+        return self.cam.isOpened()
+
+    def release(self):
+        self.running = False
+        self.thread.join(1.0)
+        self.cam.release()
+
+    def stats(self):
+        return {"frames": self.seq, "dropped": self.dropped, "duplicates": self.duplicates}
+
+
+class RecordedSource:
+    # Frames from a recording, either paced like the original frame rate or as
+    # fast as they can be processed. Timestamps are the position in the
+    # recording, so a replay gives the same timestamps and sequence numbers
+    # every time. seek(index) jumps to a frame by index.
+    def __init__(self, fps, realtime=True, loop=False):
+        self.fps = fps if fps and fps > 0 else 30.0
+        self.realtime = realtime
+        self.loop = loop
+
+        self.index = 0
+        self.ended = False
+        self.frame_seq = 0
+        self.frame_time = 0.0
+        self.frames = 0
+
+        self.start_wall = None
+        self.start_index = 0
+
+    def read_frame(self, image=None):
+        ok, frame = self.next_frame(image)
+        if not ok and self.loop and self.index > 0:
+            self.seek(0)
+            ok, frame = self.next_frame(image)
+        if not ok:
+            self.ended = True
+            return None, 0.0, 0
+
+        if self.realtime:
+            self.pace()
+        self.frames += 1
+        self.frame_seq = self.index + 1
+        self.frame_time = self.index / self.fps
+        self.index += 1
+        return frame, self.frame_time, self.frame_seq
+
+    def read(self, image=None):
+        frame, _, _ = self.read_frame(image)
+        return frame is not None, frame
+
+    def pace(self):
+        now = time.time()
+        if self.start_wall is None:
+            self.start_wall, self.start_index = now, self.index
+        delay = self.start_wall + (self.index - self.start_index) / self.fps - now
+        if delay > 0:
+            time.sleep(delay)
+
+    def seek(self, index):
+        self.index = max(0, index)
+        self.ended = False
+        self.start_wall = None
+
+    def isOpened(self):
+        return True
+
+    def stats(self):
+        return {"frames": self.frames, "dropped": 0, "duplicates": 0}
+
+
+class VideoFileSource(RecordedSource):
+    def __init__(self, path, realtime=True, loop=False):
+        self.path = path
+        self.cam = cv2.VideoCapture(path)
+        RecordedSource.__init__(self, self.cam.get(cv2.CAP_PROP_FPS), realtime, loop)
+        self.position = 0
+
+    def next_frame(self, image=None):
+        if self.position != self.index:
+            self.skip_to(self.index)
+        ok, frame = self.cam.read(image)
+        if ok:
+            self.position += 1
+        return ok, frame
+
+    def skip_to(self, index):
+        # Container seeking lands on key frames for many codecs, decoding
+        # forward from the start is slower but always gives the same frame
+        if index < self.position:
+            self.cam.release()
+            self.cam = cv2.VideoCapture(self.path)
+            self.position = 0
+        while self.position < index and self.cam.grab():
+            self.position += 1
+
+    def isOpened(self):
+        return self.cam.isOpened()
+
+    def release(self):
+        self.cam.release()
+
+
+class ImageDirectorySource(RecordedSource):
+    def __init__(self, path, fps=30, realtime=True, loop=False):
+        self.path = path
+        self.files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.lower().endswith(IMAGE_TYPES)]
+        RecordedSource.__init__(self, fps, realtime, loop)
+
+    def __len__(self):
+        return len(self.files)
+
+    def next_frame(self, image=None):
+        if self.index >= len(self.files):
+            return False, None
+        frame = cv2.imread(self.files[self.index], cv2.IMREAD_COLOR)
+        return frame is not None, frame
+
+    def isOpened(self):
+        return bool(self.files)
+
+    def release(self):
+        pass
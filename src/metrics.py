@@ -0,0 +1,140 @@
+import json
+import time
+from bisect import bisect_left
+
+# Bucket upper bounds in seconds, 10 us to 10 s, each 25% above the last.
+# Percentiles are reported as the upper bound of their bucket, so they are
+# at most 25% high and recording a value is one bisect and one increment.
+BOUNDS = [1e-5 * 1.25**i for i in range(63)]
+
+
+class Histogram:
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def add(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.count += other.count
+        self.total += other.total
+        if other.max > self.max:
+            self.max = other.max
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                if i == len(self.bounds):
+                    return self.max
+                return min(self.bounds[i], self.max)
+        return self.max
+
+    def summary(self):
+        # Milliseconds, the unit everybody reads latencies in
+        return {"count": self.count,
+                "mean": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+                "p50": round(self.percentile(50) * 1000, 3),
+                "p95": round(self.percentile(95) * 1000, 3),
+                "p99": round(self.percentile(99) * 1000, 3),
+                "max": round(self.max * 1000, 3)}
+
+
+class Metrics:
+    # Latency histograms per stage and gauges (queue depths, counters) of the
+    # tracking loop. Every interval seconds snapshot() summarizes the window
+    # since the last snapshot and starts a new one.
+
+    # TemplateTracker.stage_times calls the capture "read"
+    stage_names = {"read": "capture"}
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.histograms = dict()
+        self.gauges = dict()
+        self.peaks = dict()
+        self.frames = 0
+        self.window_start = time.time()
+
+    def record(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = Histogram()
+        histogram.record(seconds)
+
+    def record_stages(self, stage_times):
+        for stage, seconds in stage_times.items():
+            self.record(self.stage_names.get(stage, stage), seconds)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def peak(self, name, value):
+        # Highest value of the window, for queue depths between snapshots
+        if value > self.peaks.get(name, 0):
+            self.peaks[name] = value
+
+    def frame(self):
+        self.frames += 1
+
+    def due(self, now=None):
+        now = time.time() if now is None else now
+        return now - self.window_start >= self.interval
+
+    def take(self, now=None):
+        # Raw histograms of the window, to merge in another process
+        now = time.time() if now is None else now
+        window = {"time": now,
+                  "window": now - self.window_start,
+                  "frames": self.frames,
+                  "histograms": self.histograms,
+                  "gauges": dict(self.gauges),
+                  "peaks": self.peaks}
+
+        self.histograms = dict()
+        self.peaks = dict()
+        self.frames = 0
+        self.window_start = now
+        return window
+
+    def merge(self, window, prefix=""):
+        # Adds a worker's window, gauges and peaks are kept per worker
+        for name, histogram in window["histograms"].items():
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(histogram.bounds)
+            self.histograms[name].add(histogram)
+        self.frames += window["frames"]
+        for name, value in window["gauges"].items():
+            self.gauges[prefix+name] = value
+        for name, value in window["peaks"].items():
+            self.peak(prefix+name, value)
+
+    @staticmethod
+    def summarize(window):
+        elapsed = window["window"]
+        return {"time": window["time"],
+                "window": round(elapsed, 3),
+                "fps": round(window["frames"] / elapsed, 2) if elapsed > 0 else 0.0,
+                "stages": {name: h.summary() for name, h in window["histograms"].items()},
+                "gauges": window["gauges"],
+                "peaks": window["peaks"]}
+
+    def snapshot(self, now=None):
+        return self.summarize(self.take(now))
+
+    def to_json(self, now=None):
+        return json.dumps(self.snapshot(now), separators=(",", ":"))
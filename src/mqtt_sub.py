@@ -1,6 +1,8 @@
 import paho.mqtt.client
 from time import sleep
 
+import wire
+
 
 class MQTT_Client:
     def __init__(self):
@@ -23,7 +25,15 @@ class MQTT_Client:
         self.client.reconnect()
 
     def on_message(self, client, userdata, msg):
-        print("Received Message:",msg.payload)
+        if wire.is_detection(msg.payload):
+            records = wire.decode(msg.payload)
+            print("Received",len(records),"detections:")
+            for r in records:
+                print("  frame",r["seq"],"at",r["time"],"template",r["template"],
+                      "x:",r["x"],"y:",r["y"],"distance:",r["distance"],
+                      "area:",r["area"],"perimeter:",r["perimeter"])
+        else:
+            print("Received Message:",msg.payload)
 
     def on_subscribe(self, client, userdata, mid, granted_qos):
         print("Subscribed to:", client, userdata, mid, granted_qos)
@@ -3,12 +3,15 @@ import paho.mqtt.client
 from operator import itemgetter
 import numpy as np
 
+from capture import open_camera
+from tracking import VoteAccumulator
+
 class App:
     def __init__(self):
 
         self.setup()
-        self.score_filter = SummaryScoreFilter()
-        self.cam          = cv2.VideoCapture(self.settings["camera_number"])
+        self.score_filter = VoteAccumulator()
+        self.cam          = open_camera(self.settings)
         self.mqtt         = MQTT_Client(self)
 
 
@@ -28,7 +31,7 @@ class App:
 
     def setup(self):
         self.settings = dict()
-        cast_int = ["camera_number","port"]
+        cast_int = ["camera_number","port","threaded_capture","capture_buffers"]
         with open("../settings.txt","r") as file:
             for line in file:
                 if line[0] == "#" or line[0] == "":
@@ -588,52 +591,6 @@ class TemplateTracker:
             return True
 
 
-class SummaryScoreFilter:
-    def __init__(self):
-        self.tracked_objects = list()
-        self.cycles = 5
-        self.counter = 0
-
-    def cycle_control(self):
-        if self.counter >= self.cycles:
-            winner = self.select_best()
-            self.counter = 0
-            return winner
-
-        else:
-            self.counter += 1
-
-    def update(self, candidates):
-        self.tracked_objects.append(candidates)
-
-        return self.cycle_control()
-
-    def select_best(self):
-        max_ocurance = 0
-        summary = dict()
-        for round in self.tracked_objects:
-            for obj in round:
-                if str(obj) in summary:
-                    summary[str(obj)][0] += 1
-                    summary[str(obj)][1].append(obj.distance)
-                else:
-                    summary[str(obj)] = [1,[obj.distance]]
-
-        # Filter out everything with lower occurance than max occurance
-        for k in summary:
-            if summary[k][0] > max_ocurance:
-                max_ocurance = summary[k][0]
-        summary = {k:v for k, v in summary.items() if v[0] == max_ocurance}
-
-        # Average of distances, select smallest distance
-        for k in summary:
-            summary[k][1] = sum(summary[k][1]) / len(summary[k][1])
-        winner = [k for k in sorted(summary, key=summary.get(1), reverse=True)][0]
-
-        return winner
-        #print(summary,"\n")
-        self.tracked_objects = list()
-
 class BinaryFinder:
     def __init__(self, template_img, settings):
         self.settings = settings
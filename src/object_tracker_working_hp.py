@@ -1,16 +1,22 @@
 import cv2
+import numpy as np
+import os
 import paho.mqtt.client
 
+from shape_match import ContourBatch, TemplateBank
+from tracking import MultiObjectTracker
+
 
 max_distance = 0.2
 threshold = 200
 filepath_test = "../templates/hole_sqaure.png"
+template_dir = "../templates/"
 
 
 class App:
     def __init__(self):
-        self.finder = CandidatesFinder( [filepath_test] )
-        self.tracker = TrackingMaster()
+        self.finder = CandidatesFinder( template_files(template_dir) )
+        self.tracker = MultiObjectTracker()
         self.cam = cv2.VideoCapture(2)
         self.mqtt = MQTT_Client(self)
 
@@ -26,8 +32,7 @@ class App:
             original = img.copy()
 
             candidates = self.finder.find_candidates(img)
-            self.tracker.process_candidates(candidates)
-            objs = self.tracker.update()
+            objs = self.track(candidates)
             self.publish_positions(objs)
 
             self.visuals(objs, original)
@@ -39,6 +44,15 @@ class App:
         self.cam.release()
         cv2.destroyAllWindows()
 
+    def track(self, candidates):
+        # Tracks carry the last candidate assigned to them
+        tracks = self.tracker.update([c.position for c in candidates], candidates)
+        objs = list()
+        for t in tracks:
+            t.payload.track_id = t.id
+            objs.append(t.payload)
+        return objs
+
     def publish_positions(self, objs):
         msg = list()
         if objs:
@@ -98,9 +112,11 @@ class MQTT_Client:
         self.client.publish(self.output_topic, str(msg))
 
 class TrackedObject:
-    def __init__(self, contour, distance):
+    def __init__(self, contour, distance, template=None):
         self.contour = contour
         self.distance = distance
+        self.template = template
+        self.track_id = None
         self.position = self.x, self.y = self.find_center(contour)
         self.persistence = 2
         self.new = True
@@ -119,62 +135,15 @@ class TrackedObject:
     def publish(self):
         print("x:",self.x,"y:",self.y)
 
-class TrackingMaster:
-    def __init__(self):
-        self.tracked_objects = list()
-        self.watched_objects = list()
-        self.watch_index = list()
-
-        self.max_score   = 8
-        self.found_score = 3
-        self.lost_score  = -2
-
-    def add_to_watchlist(self,obj):
-        self.watched_objects.append(obj)
-        self.watch_index.append(obj.position)
-
-    def process_candidates(self, candidates):
-
-        # Prüfe ob kandidat in watch list ist. wenn nein füge ihn hinzu sonst score
-        for c in candidates:
-            if c.position in self.watch_index:
-                self.increase_score(c.position)
-            else:
-                self.add_to_watchlist(c)
-
-
-    def update(self):
-        for obj in self.watched_objects:
-            obj.persistence += self.lost_score
-            if obj.persistence <= 0:
-                self.remove_object(obj)
-
-        print(self.watched_objects)
-        return self.watched_objects
-
-    def remove_object(self,obj):
-        self.watch_index.remove(obj.position)
-        self.watched_objects.remove(obj)
-        del obj
-
-    def increase_score(self, position):
-        for obj in self.watched_objects:
-            if position == obj.position:
-                if obj.persistence > self.max_score:
-                    return
-                else:
-                    obj.persistence += self.found_score
-
-
-
-
-
 class CandidatesFinder:
     def __init__(self, templates):
         self.t_files = templates
-        self.templates = list()
+        self.bank = TemplateBank(cv2.CONTOURS_MATCH_I2)
         for t in self.t_files:
-            self.templates.append(self.process_template(t))
+            contours = self.process_template(t)
+            if contours:
+                self.bank.add(t, contours[0])
+        self.bank.build()
 
     def filter_img(self, img):
         img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -196,16 +165,19 @@ class CandidatesFinder:
         img = self.filter_img(img)
         contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
+        # Every contour against the whole bank at once, at most one template each
+        batch = ContourBatch(contours)
+        best, distances = self.bank.match(batch.hu, max_distance) #Schwellenwert
+
         candidates = list()
-        for tc in self.templates:
-            for c in contours:
-                distance = cv2.matchShapes(tc[0], c, cv2.CONTOURS_MATCH_I2,0)
-                if distance < max_distance: #Schwellenwert
-                    candidates.append(TrackedObject(c, distance))
+        for i in np.flatnonzero(best >= 0).tolist():
+            candidates.append(TrackedObject(contours[i], distances[i], self.bank.names[best[i]]))
 
         return candidates
 
 
+def template_files(path):
+    return [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".png")]
 
 
 if __name__ == "__main__":
@@ -0,0 +1,363 @@
+import multiprocessing
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from capture import open_source
+
+# Pipelined mode (pipeline=1): capture, preprocessing (blur, color, binary)
+# and contours plus matching each run in their own process, publishing stays
+# in the App process. Frames move through FrameRings in shared memory, only
+# the small match results are pickled. Every ring hands out the newest frame
+# and drops older ones the next stage didn't get to, so a slow stage costs
+# frames, not latency.
+#
+# Region of interest, pyramid search and the change gate need the previous
+# result while the next frame is processed and are not used in this mode,
+# neither is template setup ("new").
+
+FREE, WRITING, READY, READING = 0, 1, 2, 3
+
+
+class FrameRing:
+    # Shared memory block of slots frames plus their states, sequence numbers,
+    # a tag (the template generation) and a few float values per frame. One
+    # writer and one reader process, the lock is only held to move slots
+    # between states, never while copying.
+    def __init__(self, context, name, slots=3, fields=8):
+        self.name = name
+        self.slots = max(3, slots)
+        self.fields = fields
+        self.cond = context.Condition()
+        self.shm = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state["shm"] = None
+        for key in ("ints", "floats", "frames"):
+            state.pop(key, None)
+        return state
+
+    def layout(self, shape):
+        ints = (self.slots + 1) * 8 * 8
+        floats = self.slots * self.fields * 8
+        offset = (ints + floats + 63) // 64 * 64
+        return offset, offset + self.slots * int(np.prod(shape))
+
+    def create(self, shape):
+        offset, size = self.layout(shape)
+        self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        self.map(shape, offset)
+        self.ints[:] = 0
+        self.ints[0, 2:2 + len(shape)] = shape
+
+    def attach(self):
+        self.shm = shared_memory.SharedMemory(name=self.name)
+        header = np.ndarray(8, np.int64, self.shm.buf)
+        shape = tuple(int(v) for v in header[2:5] if v)
+        self.map(shape, self.layout(shape)[0])
+
+    def map(self, shape, offset):
+        # Row 0 holds dropped, written and the frame shape, then state, seq, tag per slot
+        self.shape = shape
+        self.ints = np.ndarray((self.slots + 1, 8), np.int64, self.shm.buf)
+        self.floats = np.ndarray((self.slots, self.fields), np.float64, self.shm.buf, (self.slots + 1) * 64)
+        self.frames = np.ndarray((self.slots,) + shape, np.uint8, self.shm.buf, offset)
+
+    def write_slot(self):
+        # A free slot, else the oldest frame nobody read yet
+        with self.cond:
+            states = self.ints[1:, 0]
+            free = np.flatnonzero(states == FREE)
+            if len(free):
+                i = int(free[0])
+            else:
+                ready = np.flatnonzero(states == READY)
+                i = int(ready[np.argmin(self.ints[1 + ready, 1])])
+                self.ints[0, 0] += 1
+            self.ints[1 + i, 0] = WRITING
+        return i, self.frames[i]
+
+    def commit(self, i, seq, tag, values=()):
+        self.floats[i, :len(values)] = values
+        with self.cond:
+            self.ints[1 + i, :3] = (READY, seq, tag)
+            self.ints[0, 1] += 1
+            self.cond.notify_all()
+
+    def abort(self, i):
+        with self.cond:
+            self.ints[1 + i, 0] = FREE
+
+    def read_slot(self, timeout=0.5):
+        # Newest ready frame, older ready frames are stale and dropped
+        with self.cond:
+            ready = np.flatnonzero(self.ints[1:, 0] == READY)
+            if not len(ready):
+                self.cond.wait(timeout)
+                ready = np.flatnonzero(self.ints[1:, 0] == READY)
+                if not len(ready):
+                    return None
+            seqs = self.ints[1 + ready, 1]
+            i = int(ready[np.argmax(seqs)])
+            for j in ready.tolist():
+                if j != i:
+                    self.ints[1 + j, 0] = FREE
+                    self.ints[0, 0] += 1
+            self.ints[1 + i, 0] = READING
+        return i
+
+    def release(self, i):
+        with self.cond:
+            self.ints[1 + i, 0] = FREE
+
+    def seq(self, i):
+        return int(self.ints[1 + i, 1])
+
+    def tag(self, i):
+        return int(self.ints[1 + i, 2])
+
+    def stats(self):
+        if self.shm is None:
+            return {"written": 0, "dropped": 0}
+        return {"written": int(self.ints[0, 1]), "dropped": int(self.ints[0, 0])}
+
+    def close(self, unlink=False):
+        if self.shm is None:
+            return
+        self.ints = self.floats = self.frames = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+        self.shm = None
+
+
+class StageApp:
+    # What TemplateTracker needs from App inside a stage process
+    def __init__(self, settings):
+        self.settings = dict(settings, roi_mode=0, change_gate=0, headless=1)
+        self.state = "tracking"
+
+
+def load_template(settings, name):
+    from valu_vision import Template
+    template = Template()
+    template.load(settings["template_filepath"]+name)
+    return template
+
+
+def stage_tracker(settings, ring, control, current):
+    # Tracker for the latest load command, the current one while there is no
+    # new command. The ring only stands in for the source, it is read by the stage.
+    from valu_vision import TemplateTracker
+    update = None
+    try:
+        while True:
+            update = control.get_nowait()
+    except queue.Empty:
+        pass
+    if update is None:
+        return current
+    name, generation = update
+    return TemplateTracker(StageApp(settings), load_template(settings, name), ring), generation
+
+
+def capture_stage(settings, ring, ready, ended, stop):
+    source = open_source(settings)
+    frame = None
+    while frame is None and not stop.is_set():
+        frame, _, _ = source.read_frame()
+    if frame is None:
+        return
+    ring.create(frame.shape)
+    ready.put(frame.shape)
+
+    try:
+        while not stop.is_set():
+            i, view = ring.write_slot()
+            if frame is None:
+                # Straight into shared memory where the source supports it
+                ok, frame = source.read(view)
+                if not ok:
+                    ring.abort(i)
+                    if source.ended:
+                        ended.set()
+                        break
+                    frame = None
+                    continue
+            if frame is not view:
+                np.copyto(view, frame)
+            ring.commit(i, source.frame_seq, 0, (source.frame_time, time.time()))
+            frame = None
+    finally:
+        source.release()
+        ring.close(unlink=True)
+
+
+def preprocess_stage(settings, src, dst, control, stop):
+    src.attach()
+    dst.attach()
+    tracker, generation = None, 0
+    while not stop.is_set():
+        tracker, generation = stage_tracker(settings, src, control, (tracker, generation))
+        i = src.read_slot()
+        if i is None:
+            continue
+        if tracker is None:
+            src.release(i)
+            continue
+
+        tracker.stage_times = dict()
+        _, _, _, binary = tracker.preprocess(src.frames[i], tracker.buffers)
+        frame_time, wall = src.floats[i, :2]
+        seq = src.seq(i)
+        src.release(i)
+
+        j, view = dst.write_slot()
+        np.copyto(view, binary)
+        times = tracker.stage_times
+        dst.commit(j, seq, generation, (frame_time, wall, times["blur"], times["color"], times["binary"]))
+    src.close()
+    dst.close()
+
+
+def match_stage(settings, src, results, control, stop):
+    src.attach()
+    tracker, generation = None, 0
+    while not stop.is_set():
+        tracker, generation = stage_tracker(settings, src, control, (tracker, generation))
+        i = src.read_slot()
+        if i is None:
+            continue
+        if tracker is None or src.tag(i) != generation:
+            # Preprocessed with the template before the last load
+            src.release(i)
+            continue
+
+        state = tracker.template_cache.get(tracker.template)
+        tracker.stage_times = dict()
+        contours = tracker.get_contour(src.frames[i])
+        frame_time, wall, blur, color, binary = src.floats[i, :5].tolist()
+        seq = src.seq(i)
+        src.release(i)
+
+        matches = tracker.get_matches(contours, state.contours) or []
+        times = dict(tracker.stage_times, blur=blur, color=color, binary=binary)
+
+        result = (seq, frame_time, wall, generation, matches, times)
+        try:
+            results.put_nowait(result)
+        except queue.Full:
+            # Nobody picked up the last one, replace it
+            try:
+                results.get_nowait()
+            except queue.Empty:
+                pass
+            results.put_nowait(result)
+    src.close()
+
+
+class RemoteSource:
+    # App's view of the source running in the capture process
+    def __init__(self, ring, ended):
+        self.ring = ring
+        self.ended_event = ended
+
+    @property
+    def ended(self):
+        return self.ended_event.is_set()
+
+    def stats(self):
+        stats = self.ring.stats()
+        return {"frames": stats["written"], "dropped": stats["dropped"], "duplicates": 0}
+
+
+class Pipeline:
+    # Stands in for TemplateTracker in App: load() a template, update() for
+    # the newest result.
+    def __init__(self, settings, slots=3):
+        self.settings = settings
+        # spawn instead of fork, forked OpenCV and paho threads don't survive
+        context = multiprocessing.get_context("spawn")
+        prefix = "vv"+str(multiprocessing.current_process().pid)+"_"+str(id(self) % 100000)
+        self.frames = FrameRing(context, prefix+"_frames", slots)
+        self.binary = FrameRing(context, prefix+"_binary", slots)
+        self.results = context.Queue(maxsize=2)
+        self.controls = [context.Queue(), context.Queue()]
+        self.stop_event = context.Event()
+        self.ended = context.Event()
+        ready = context.Queue()
+
+        self.processes = [context.Process(target=capture_stage, name="capture", daemon=True,
+                                          args=(settings, self.frames, ready, self.ended, self.stop_event))]
+        self.processes[0].start()
+        shape = ready.get(timeout=30)
+        self.binary.create(shape[:2])
+        self.frames.attach()
+
+        self.processes += [
+            context.Process(target=preprocess_stage, name="preprocess", daemon=True,
+                            args=(settings, self.frames, self.binary, self.controls[0], self.stop_event)),
+            context.Process(target=match_stage, name="match", daemon=True,
+                            args=(settings, self.binary, self.results, self.controls[1], self.stop_event)),
+            ]
+        for process in self.processes[1:]:
+            process.start()
+
+        self.cam = RemoteSource(self.frames, self.ended)
+        # Frames stay in the stage processes, there is nothing to preview
+        self.img = None
+        self.template = None
+        self.generation = 0
+        # Results of the current generation, see App.report_swap
+        self.tracked = 0
+        self.matches = list()
+        self.f_matches = None
+        self.frame_seq = 0
+        self.frame_time = 0.0
+        self.stage_times = dict()
+
+    def load(self, name):
+        self.template = load_template(self.settings, name)
+        self.generation += 1
+        self.tracked = 0
+        for control in self.controls:
+            control.put((name, self.generation))
+
+    def update(self, timeout=1.0):
+        result = None
+        try:
+            result = self.results.get(timeout=timeout)
+            while True:
+                result = self.results.get_nowait()
+        except queue.Empty:
+            pass
+
+        if result is not None and result[3] == self.generation:
+            seq, frame_time, wall, generation, matches, times = result
+            self.frame_seq, self.frame_time = seq, frame_time
+            self.stage_times = times
+            # Capture to result, across all stages
+            self.stage_times["latency"] = time.time() - wall
+            self.matches = self.f_matches = matches
+            self.tracked += 1
+        return self.f_matches
+
+    def show(self):
+        # Frames stay in the stage processes
+        pass
+
+    def stats(self):
+        # The template cache, cascade and gate live in the stage processes
+        return dict()
+
+    def stop(self):
+        self.stop_event.set()
+        for process in self.processes:
+            process.join(2.0)
+            if process.is_alive():
+                process.terminate()
+        self.frames.close()
+        self.binary.close(unlink=True)
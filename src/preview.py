@@ -0,0 +1,131 @@
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+# A look at the line for boxes running headless. At most fps times a second
+# the tracking loop copies the frame, drawing and JPEG encoding happen on a
+# side thread, every other frame costs one comparison:
+#   preview_file=/tmp/line1.jpg   replaced with every preview frame
+#   preview_port=8090             MJPEG stream on http://127.0.0.1:8090/
+# The stream only listens on localhost, forward the port to look from elsewhere.
+
+
+class Preview:
+    def __init__(self, fps=2.0, path="", port=0, draw=None, quality=80):
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.path = path
+        self.draw = draw
+        self.quality = quality
+
+        self.frame = None
+        self.matches = None
+        self.pending = False
+        self.taken = 0.0
+        self.jpeg = None
+        self.encoded = 0
+        self.running = True
+        self.cond = threading.Condition()
+
+        self.thread = threading.Thread(target=self.run, name="preview", daemon=True)
+        self.thread.start()
+
+        self.server = None
+        if port:
+            self.server = ThreadingHTTPServer(("127.0.0.1", port), stream_handler(self))
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name="preview_http", daemon=True).start()
+            print("Preview on http://127.0.0.1:"+str(port)+"/")
+
+    def offer(self, img, matches, now=None):
+        # Every frame from the tracking loop. Takes a copy when a preview is
+        # due and the last one is encoded, never waits for the encoder.
+        now = time.monotonic() if now is None else now
+        if img is None or self.pending or now - self.taken < self.interval:
+            return
+        self.taken = now
+        if self.frame is None or self.frame.shape != img.shape:
+            self.frame = np.empty_like(img)
+        np.copyto(self.frame, img)
+        with self.cond:
+            self.matches = matches
+            self.pending = True
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.running and not self.pending:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                matches = self.matches
+
+            img = self.frame
+            if self.draw and matches:
+                img = self.draw(img, matches)
+            ok, jpeg = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            if ok and self.path:
+                self.write(jpeg)
+
+            with self.cond:
+                if ok:
+                    self.jpeg = jpeg.tobytes()
+                    self.encoded += 1
+                # offer() may reuse the frame now
+                self.pending = False
+                self.cond.notify_all()
+
+    def write(self, jpeg):
+        # Replaced in one step, a viewer never reads half a file
+        try:
+            with open(self.path+".tmp", "wb") as file:
+                file.write(jpeg.tobytes())
+            os.replace(self.path+".tmp", self.path)
+        except OSError as e:
+            print("Preview not written:", e)
+
+    def wait(self, encoded, timeout):
+        # Next JPEG after the encoded'th one, None on timeout or stop
+        with self.cond:
+            self.cond.wait_for(lambda: self.encoded != encoded or not self.running, timeout)
+            if self.encoded == encoded or not self.running:
+                return None, encoded
+            return self.jpeg, self.encoded
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        self.thread.join(1.0)
+
+
+def stream_handler(preview):
+    class StreamHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            encoded = 0
+            try:
+                while preview.running:
+                    jpeg, encoded = preview.wait(encoded, 5.0)
+                    if jpeg is None:
+                        continue
+                    self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                                     + str(len(jpeg)).encode() + b"\r\n\r\n" + jpeg + b"\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, format, *args):
+            # Not a line per request on the console
+            pass
+
+    return StreamHandler
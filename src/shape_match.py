@@ -0,0 +1,443 @@
+import cv2
+import time
+import numpy as np
+
+# Same cut-off cv2.matchShapes uses to ignore vanishing Hu moments
+EPS = 1e-5
+
+
+class ContourBatch:
+    # Geometry of a whole frame's contours computed in one NumPy pass.
+    # Moments follow OpenCV's contour moments (Green's theorem over the polygon
+    # edges), so centroids, areas and Hu moments agree with cv2.moments,
+    # cv2.contourArea and cv2.matchShapes.
+    def __init__(self, contours):
+        self.contours = contours
+        self.count = len(contours)
+
+        lengths = np.array(list(map(len, contours)), np.intp)
+        self.starts = np.zeros(self.count, np.intp)
+        np.cumsum(lengths[:-1], out=self.starts[1:])
+        self.lengths = lengths
+
+        if self.count:
+            pts = np.concatenate(contours).reshape(-1, 2).astype(np.float64)
+        else:
+            pts = np.zeros((0, 2))
+        self.x = pts[:, 0]
+        self.y = pts[:, 1]
+
+        # Index of the previous point of every point, wrapping inside its contour
+        self.prev = np.arange(len(pts)) - 1
+        self.prev[self.starts] = self.starts + lengths - 1
+
+        self._moments = None
+        self._hu = None
+        self._area = None
+        self._perimeter = None
+        self._bbox = None
+
+    def edge_sum(self, values):
+        if not self.count:
+            return np.zeros((0,) + values.shape[1:])
+        return np.add.reduceat(values, self.starts, axis=0)
+
+    @property
+    def moments(self):
+        # Spatial moments m00..m03 as columns of a N x 10 array
+        if self._moments is None:
+            self._moments = self.compute_moments()
+        return self._moments
+
+    def compute_moments(self):
+        xi, yi = self.x, self.y
+        xp, yp = self.x[self.prev], self.y[self.prev]
+
+        xi2, yi2 = xi * xi, yi * yi
+        xp2, yp2 = xp * xp, yp * yp
+        dxy = xp * yi - xi * yp
+        xii = xp + xi
+        yii = yp + yi
+
+        terms = np.empty((len(xi), 10))
+        terms[:, 0] = 1
+        terms[:, 1] = xii
+        terms[:, 2] = yii
+        terms[:, 3] = xp * xii + xi2
+        terms[:, 4] = xp * (yii + yp) + xi * (yii + yi)
+        terms[:, 5] = yp * yii + yi2
+        terms[:, 6] = xii * (xp2 + xi2)
+        terms[:, 7] = xp2 * (3 * yp + yi) + 2 * xi * xp * yii + xi2 * (yp + 3 * yi)
+        terms[:, 8] = yp2 * (3 * xp + xi) + 2 * yi * yp * xii + yi2 * (xp + 3 * xi)
+        terms[:, 9] = yii * (yp2 + yi2)
+        terms *= dxy[:, None]
+
+        # a00 a10 a01 a20 a11 a02 a30 a21 a12 a03, scaled to m00 .. m03
+        m = self.edge_sum(terms)
+        m /= (2, 6, 6, 12, 24, 12, 20, 60, 60, 20)
+        a00 = m[:, 0]
+        # Orientation independent like OpenCV, degenerate contours have no moments
+        m *= np.sign(a00)[:, None]
+        m[np.abs(a00) <= np.finfo(np.float32).eps] = 0
+        return m
+
+    @property
+    def area(self):
+        if self._moments is not None:
+            return self._moments[:, 0]
+        if self._area is None:
+            # Shoelace only, cheaper than the full moment set
+            dxy = self.x[self.prev] * self.y - self.x * self.y[self.prev]
+            self._area = np.abs(self.edge_sum(dxy)) / 2
+        return self._area
+
+    @property
+    def bbox(self):
+        # x, y, w, h like cv2.boundingRect
+        if self._bbox is None:
+            if not self.count:
+                return np.zeros((0, 4))
+            x0 = np.minimum.reduceat(self.x, self.starts)
+            y0 = np.minimum.reduceat(self.y, self.starts)
+            x1 = np.maximum.reduceat(self.x, self.starts)
+            y1 = np.maximum.reduceat(self.y, self.starts)
+            self._bbox = np.stack([x0, y0, x1 - x0 + 1, y1 - y0 + 1], axis=1)
+        return self._bbox
+
+    def subset(self, idx):
+        return ContourBatch([self.contours[i] for i in idx])
+
+    @property
+    def perimeter(self):
+        if self._perimeter is None:
+            seg = np.hypot(self.x - self.x[self.prev], self.y - self.y[self.prev])
+            self._perimeter = self.edge_sum(seg)
+        return self._perimeter
+
+    @property
+    def centers(self):
+        # Integer centroids like TemplateTracker.get_center, (0, 0) for empty contours
+        m = self.moments
+        m00 = m[:, 0]
+        safe = np.where(m00 == 0, 1, m00)
+        cx = np.where(m00 == 0, 0, np.trunc(m[:, 1] / safe))
+        cy = np.where(m00 == 0, 0, np.trunc(m[:, 2] / safe))
+        return np.stack([cx, cy], axis=1).astype(int)
+
+    @property
+    def hu(self):
+        if self._hu is None:
+            self._hu = hu_moments(self.moments)
+        return self._hu
+
+    def distances(self, template_hu, method=cv2.CONTOURS_MATCH_I1):
+        return hu_distances(template_hu, self.hu, method)
+
+
+def hu_moments(m):
+    m00, m10, m01, m20, m11, m02, m30, m21, m12, m03 = m.T
+
+    nonzero = m00 != 0
+    safe = np.where(nonzero, m00, 1)
+    cx = np.where(nonzero, m10 / safe, 0)
+    cy = np.where(nonzero, m01 / safe, 0)
+
+    mu20 = m20 - m10 * cx
+    mu11 = m11 - m10 * cy
+    mu02 = m02 - m01 * cy
+    mu30 = m30 - cx * (3 * mu20 + cx * m10)
+    mu21 = m21 - cx * (2 * mu11 + cx * m01) - cy * mu20
+    mu12 = m12 - cy * (2 * mu11 + cy * m10) - cx * mu02
+    mu03 = m03 - cy * (3 * mu02 + cy * m01)
+
+    inv = np.where(nonzero, 1 / np.abs(safe), 0)
+    s2 = inv * inv
+    s3 = s2 * np.sqrt(inv)
+    nu20, nu11, nu02 = mu20 * s2, mu11 * s2, mu02 * s2
+    nu30, nu21, nu12, nu03 = mu30 * s3, mu21 * s3, mu12 * s3, mu03 * s3
+
+    hu = np.empty((len(m), 7))
+    t0 = nu30 + nu12
+    t1 = nu21 + nu03
+    q0 = t0 * t0
+    q1 = t1 * t1
+    n4 = 4 * nu11
+    s = nu20 + nu02
+    d = nu20 - nu02
+
+    hu[:, 0] = s
+    hu[:, 1] = d * d + n4 * nu11
+    hu[:, 3] = q0 + q1
+    hu[:, 5] = d * (q0 - q1) + n4 * t0 * t1
+
+    t0 = t0 * (q0 - 3 * q1)
+    t1 = t1 * (3 * q0 - q1)
+    q0 = nu30 - 3 * nu12
+    q1 = 3 * nu21 - nu03
+
+    hu[:, 2] = q0 * q0 + q1 * q1
+    hu[:, 4] = q0 * t0 + q1 * t1
+    hu[:, 6] = q1 * t0 - q0 * t1
+    return hu
+
+
+def log_hu(hu):
+    # Signed log10 of the Hu moments, NaN where cv2.matchShapes ignores them
+    hu = np.asarray(hu, np.float64)
+    mag = np.abs(hu)
+    out = np.full(hu.shape, np.nan)
+    valid = mag > EPS
+    out[valid] = np.sign(hu[valid]) * np.log10(mag[valid])
+    return out
+
+
+def hu_distances(template_hu, hu, method=cv2.CONTOURS_MATCH_I1):
+    # cv2.matchShapes(template, contour, method) for every row of hu at once
+    template_hu = np.asarray(template_hu, np.float64).reshape(-1, 7)
+    hu = np.asarray(hu, np.float64).reshape(-1, 7)
+
+    a = log_hu(template_hu)[:, None, :]
+    b = log_hu(hu)[None, :, :]
+    valid = ~(np.isnan(a) | np.isnan(b))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if method == cv2.CONTOURS_MATCH_I1:
+            terms = np.abs(1 / b - 1 / a)
+            result = np.where(valid, terms, 0).sum(axis=2)
+        elif method == cv2.CONTOURS_MATCH_I2:
+            terms = np.abs(b - a)
+            result = np.where(valid, terms, 0).sum(axis=2)
+        elif method == cv2.CONTOURS_MATCH_I3:
+            terms = np.abs((a - b) / a)
+            result = np.where(valid, terms, 0).max(axis=2, initial=0)
+        else:
+            raise ValueError("Unknown shape matching method: " + str(method))
+
+    # Like OpenCV, an all-zero moment set never matches a non-zero one
+    any_a = np.any(template_hu != 0, axis=1)[:, None]
+    any_b = np.any(hu != 0, axis=1)[None, :]
+    result[any_a != any_b] = np.finfo(np.float64).max
+
+    if result.shape[0] == 1:
+        return result[0]
+    return result
+
+
+class RejectionCascade:
+    # Runs the cheap geometric tests first and the shape distance only on the
+    # contours that survive them. Stages that are switched off in the template
+    # config (filter value 0) are skipped. Rejections are counted per stage,
+    # for the last frame and in total, to tune the order per template, times
+    # holds the seconds each stage took in the last run.
+    stages = ("bbox", "area", "perimeter", "aspect", "solidity", "distance")
+
+    def __init__(self, order=None):
+        order = list(order or self.stages)
+        for stage in order:
+            if stage not in self.stages:
+                raise ValueError("Unknown cascade stage: " + str(stage))
+        if "distance" not in order:
+            order.append("distance")
+        self.order = order
+
+        self.rejected = dict.fromkeys(self.order, 0)
+        self.last = dict.fromkeys(self.order, 0)
+        self.times = dict.fromkeys(self.order, 0.0)
+        self.frames = 0
+        self.contours = 0
+        self.scale = 1
+
+    def run(self, contours, state, config, method=cv2.CONTOURS_MATCH_I1, filters=True, scale=1):
+        # Returns a batch of the surviving contours, their indices into
+        # contours and their shape distances. scale is the size of the
+        # contours relative to the template, the filter bands follow it.
+        self.scale = scale
+        batch = ContourBatch(contours)
+        idx = np.arange(batch.count)
+        distances = np.zeros(0)
+
+        self.frames += 1
+        self.contours += batch.count
+        self.last = dict.fromkeys(self.order, 0)
+        self.times = dict.fromkeys(self.order, 0.0)
+
+        for stage in self.order:
+            if not len(idx):
+                break
+            start = time.perf_counter()
+            if stage == "distance":
+                # Moments and Hu only for what is left
+                sub = batch.subset(idx) if len(idx) < batch.count else batch
+                distances = sub.distances(state.hu, method)
+                keep = distances < config["MaxDistance"]
+                distances = distances[keep]
+            elif filters:
+                keep = getattr(self, stage)(batch, idx, state, config)
+                if keep is None:
+                    continue
+                if len(distances):
+                    distances = distances[keep]
+            else:
+                continue
+
+            self.times[stage] = time.perf_counter() - start
+            self.last[stage] = len(idx) - int(np.count_nonzero(keep))
+            self.rejected[stage] += self.last[stage]
+            idx = idx[keep]
+
+        if not len(idx):
+            return ContourBatch([]), idx, np.zeros(0)
+        if len(idx) < batch.count:
+            batch = batch.subset(idx)
+        return batch, idx, distances
+
+    def area_band(self, state, config):
+        s2 = self.scale * self.scale
+        band = config["AreaFilter"] * s2
+        if self.scale < 1:
+            # Downscaled outlines can be off by about a pixel all around
+            band += state.perimeter * self.scale
+        return state.area * s2 - band, state.area * s2 + band
+
+    def perimeter_band(self, state, config):
+        band = config["PerimeterFilter"] * self.scale
+        if self.scale < 1:
+            band += 2 * np.pi
+        return state.perimeter * self.scale - band, state.perimeter * self.scale + band
+
+    def bbox(self, batch, idx, state, config):
+        # A contour can't cover more than its bounding box and can't be
+        # shorter than twice the box diagonal
+        if not config["AreaFilter"] and not config["PerimeterFilter"]:
+            return None
+        x, y, w, h = batch.bbox[idx].T
+        keep = np.ones(len(idx), bool)
+        if config["AreaFilter"]:
+            keep &= w * h > self.area_band(state, config)[0]
+        if config["PerimeterFilter"]:
+            keep &= 2 * np.hypot(w - 1, h - 1) < self.perimeter_band(state, config)[1] + 1e-6
+        return keep
+
+    def area(self, batch, idx, state, config):
+        if not config["AreaFilter"]:
+            return None
+        lower, upper = self.area_band(state, config)
+        a = batch.area[idx]
+        return (a > lower) & (a < upper)
+
+    def perimeter(self, batch, idx, state, config):
+        if not config["PerimeterFilter"]:
+            return None
+        lower, upper = self.perimeter_band(state, config)
+        l = batch.perimeter[idx]
+        return (l > lower) & (l < upper)
+
+    def aspect(self, batch, idx, state, config):
+        # Aspect ratio of the rotated bounding rect, AspectFilter in percent
+        if not config.get("AspectFilter", 0):
+            return None
+        aspect = np.array([min_rect_aspect(batch.contours[i]) for i in idx])
+        return np.abs(aspect - state.aspect) <= state.aspect * config["AspectFilter"] / 100
+
+    def solidity(self, batch, idx, state, config):
+        # Area over convex hull area, SolidityFilter in percentage points
+        if not config.get("SolidityFilter", 0):
+            return None
+        solidity = np.array([contour_solidity(batch.contours[i]) for i in idx])
+        return np.abs(solidity - state.solidity) * 100 <= config["SolidityFilter"]
+
+    def stats(self):
+        return {"frames": self.frames, "contours": self.contours,
+                "rejected": dict(self.rejected), "last": dict(self.last)}
+
+
+def min_rect_aspect(contour):
+    _, (w, h), _ = cv2.minAreaRect(contour)
+    if min(w, h) == 0:
+        return 0.0
+    return max(w, h) / min(w, h)
+
+
+def contour_solidity(contour):
+    hull_area = cv2.contourArea(cv2.convexHull(contour))
+    if hull_area == 0:
+        return 0.0
+    return cv2.contourArea(contour) / hull_area
+
+
+class TemplateBank:
+    # Precomputed descriptors for a whole template catalogue, matched against
+    # all contours of a frame at once. Templates are sorted on their first
+    # log-Hu feature: its difference alone is a lower bound of the I1/I2
+    # distance, so only templates within max_distance along that axis get the
+    # full distance, which keeps the cost flat as the catalogue grows.
+    def __init__(self, method=cv2.CONTOURS_MATCH_I2):
+        if method not in (cv2.CONTOURS_MATCH_I1, cv2.CONTOURS_MATCH_I2):
+            raise ValueError("TemplateBank supports CONTOURS_MATCH_I1 and I2 only")
+        self.method   = method
+        self.names    = list()
+        self.contours = list()
+        self.hu       = np.zeros((0, 7))
+        self.build()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, contour):
+        self.names.append(name)
+        self.contours.append(contour)
+        self.hu = np.vstack([self.hu, ContourBatch([contour]).hu])
+
+    def build(self):
+        # Call after adding templates
+        features = self.features(self.hu)
+        usable = np.flatnonzero(~np.isnan(features[:, 0]))
+        order = usable[np.argsort(features[usable, 0], kind="stable")]
+        self.index = order
+        self.keys = features[order, 0]
+        self.matrix = features[order]
+
+    def features(self, hu):
+        features = log_hu(hu)
+        if self.method == cv2.CONTOURS_MATCH_I1:
+            with np.errstate(divide="ignore"):
+                features = 1 / features
+        return features
+
+    def match(self, hu, max_distance):
+        # Best template per row of hu: template index (-1 for none) and distance
+        b = self.features(hu)
+        count = len(b)
+        best = np.full(count, -1)
+        best_distance = np.full(count, np.inf)
+        if not count or not len(self.keys):
+            return best, best_distance
+
+        lo = np.searchsorted(self.keys, b[:, 0] - max_distance, "left")
+        hi = np.searchsorted(self.keys, b[:, 0] + max_distance, "right")
+        hi[np.isnan(b[:, 0])] = lo[np.isnan(b[:, 0])]
+        counts = hi - lo
+        total = int(counts.sum())
+        if not total:
+            return best, best_distance
+
+        # Flattened (contour, template) candidate pairs
+        rows = np.repeat(np.arange(count), counts)
+        cols = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+
+        a = self.matrix[cols]
+        c = b[rows]
+        valid = ~(np.isnan(a) | np.isnan(c))
+        distances = np.where(valid, np.abs(c - a), 0).sum(axis=1)
+
+        # Smallest distance per contour, first template wins ties
+        order = np.lexsort((distances, rows))
+        rows, cols, distances = rows[order], cols[order], distances[order]
+        first = np.ones(total, bool)
+        first[1:] = rows[1:] != rows[:-1]
+        rows, cols, distances = rows[first], cols[first], distances[first]
+
+        hit = distances < max_distance
+        best[rows[hit]] = self.index[cols[hit]]
+        best_distance[rows[hit]] = distances[hit]
+        return best, best_distance
@@ -0,0 +1,191 @@
+import json
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+import cv2
+import paho.mqtt.client
+
+from metrics import Metrics
+from template_store import TemplateWatcher
+from valu_vision import App, read_settings
+
+# Runs one App per camera of camera_number, each in its own process:
+#   camera_number=0,2,4
+# Every worker reads the same templates from template_filepath and listens on
+# the shared input_topic, so one load or tuning command reaches every camera.
+# Results go to output_topic/cam<n>, metrics to output_topic/cam<n>/metrics,
+# tuning replies to output_topic/cam<n>/tuning and the combined metrics of
+# all workers to metrics_topic (output_topic/metrics).
+# Previews go to preview_file with _cam<n> added and to preview_port plus the
+# worker's position in camera_number.
+
+
+def camera_topic(settings, camera, key):
+    return settings[key]+"/cam"+str(camera)
+
+
+def worker(camera, core, overrides, events):
+    if core is not None and hasattr(os, "sched_setaffinity"):
+        # One core per camera, OpenCV's own thread pool would only compete for it
+        os.sched_setaffinity(0, {core})
+        cv2.setNumThreads(1)
+    app = App(overrides=overrides, events=events)
+    # Supervisor.stop terminates the worker, shutting down releases the
+    # camera and stops the stage processes of pipeline=1
+    signal.signal(signal.SIGTERM, lambda signum, frame: app.shutdown())
+    app.main_loop()
+
+
+class Worker:
+    def __init__(self, camera, core):
+        self.camera = camera
+        self.core = core
+        self.process = None
+        self.template = None
+        self.restarts = 0
+        self.started = 0.0
+        self.restart_at = None
+        self.done = False
+
+
+class Supervisor:
+    def __init__(self, settings=None):
+        self.settings = settings or read_settings()
+        cameras = self.settings["camera_number"]
+        self.cameras = cameras if isinstance(cameras, list) else [cameras]
+
+        # spawn instead of fork, forked OpenCV and paho threads don't survive
+        self.context = multiprocessing.get_context("spawn")
+        self.events = self.context.Queue()
+
+        cores = os.cpu_count() or 1
+        pin = self.settings.get("pin_workers", 0) and len(self.cameras) <= cores
+        self.workers = [Worker(camera, i if pin else None) for i, camera in enumerate(self.cameras)]
+        self.restart_delay = self.settings.get("restart_delay", 2.0)
+
+        self.watcher = None
+        if self.settings.get("template_watch", 0):
+            self.watcher = TemplateWatcher(self.settings["template_filepath"], self.settings["template_watch"])
+
+        self.metrics = Metrics(self.settings.get("metrics_interval", 10.0))
+        self.cameras_metrics = dict()
+        self.metrics_topic = self.settings.get("metrics_topic") or self.settings["output_topic"]+"/metrics"
+        self.client = None
+        if self.settings.get("metrics", 0):
+            self.client = paho.mqtt.client.Client()
+            self.client.connect(self.settings["broker"], self.settings["port"], 60)
+            self.client.loop_start()
+
+    def overrides(self, w):
+        overrides = {"camera_number": w.camera,
+                     "output_topic": camera_topic(self.settings, w.camera, "output_topic"),
+                     "metrics_topic": ""}
+        if self.settings.get("metrics_topic"):
+            overrides["metrics_topic"] = camera_topic(self.settings, w.camera, "metrics_topic")
+        if self.settings.get("tuning_topic"):
+            overrides["tuning_topic"] = camera_topic(self.settings, w.camera, "tuning_topic")
+        # Every worker gets its own preview file and port
+        if self.settings.get("preview_file"):
+            root, ext = os.path.splitext(self.settings["preview_file"])
+            overrides["preview_file"] = root+"_cam"+str(w.camera)+ext
+        if self.settings.get("preview_port", 0):
+            overrides["preview_port"] = self.settings["preview_port"] + self.workers.index(w)
+        if w.template:
+            overrides["startup_template"] = w.template
+        return overrides
+
+    def start(self, w):
+        # Not daemonic, with pipeline=1 a worker starts processes of its own
+        w.process = self.context.Process(target=worker, name="camera"+str(w.camera),
+                                         args=(w.camera, w.core, self.overrides(w), self.events))
+        w.process.start()
+        w.started = time.time()
+        w.restart_at = None
+        print("Started worker for camera", w.camera, "pid", w.process.pid)
+
+    def run(self):
+        for w in self.workers:
+            self.start(w)
+        try:
+            while not all(w.done for w in self.workers):
+                self.read_events(0.5)
+                self.check_workers()
+                self.report_metrics()
+        except KeyboardInterrupt:
+            print("Stopping workers")
+        finally:
+            self.stop()
+
+    def read_events(self, timeout):
+        try:
+            kind, camera, payload = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            if kind == "template":
+                for w in self.workers:
+                    if w.camera == camera:
+                        w.template = payload
+            elif kind == "metrics":
+                self.metrics.merge(payload, "cam"+str(camera)+".")
+                self.cameras_metrics["cam"+str(camera)] = Metrics.summarize(payload)
+            try:
+                kind, camera, payload = self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def check_workers(self):
+        now = time.time()
+        for w in self.workers:
+            if w.done or w.process.is_alive():
+                continue
+            if w.process.exitcode == 0:
+                # Quit command, not a crash
+                print("Worker for camera", w.camera, "stopped")
+                w.done = True
+                continue
+            if w.restart_at is None:
+                # Back off when it keeps crashing right after the start
+                delay = self.restart_delay
+                if now - w.started < 10 * self.restart_delay:
+                    delay *= min(2 ** w.restarts, 16)
+                w.restart_at = now + delay
+                print("Worker for camera", w.camera, "crashed with", w.process.exitcode,
+                      "restarting in", delay, "s")
+            elif now >= w.restart_at:
+                w.restarts += 1
+                self.start(w)
+
+    def report_metrics(self):
+        if not self.client or not self.metrics.due():
+            return
+        for w in self.workers:
+            self.metrics.gauge("cam"+str(w.camera)+".restarts", w.restarts)
+            self.metrics.gauge("cam"+str(w.camera)+".alive", int(w.process.is_alive()))
+        snapshot = self.metrics.snapshot()
+        snapshot["cameras"] = self.cameras_metrics
+        self.cameras_metrics = dict()
+        self.client.publish(self.metrics_topic, json.dumps(snapshot, separators=(",", ":")))
+
+    def stop(self):
+        running = [w.process for w in self.workers if w.process and w.process.is_alive()]
+        for process in running:
+            process.terminate()
+        for process in running:
+            # A worker's pipeline takes a few seconds to stop its stages
+            process.join(10.0)
+            if process.is_alive():
+                process.kill()
+                process.join()
+        if self.watcher:
+            self.watcher.stop()
+        if self.client:
+            self.client.loop_stop()
+            self.client.disconnect()
+
+
+if __name__ == "__main__":
+    Supervisor().run()
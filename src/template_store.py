@@ -0,0 +1,234 @@
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+# Compiled templates: name.png and name.config become name.vvt, the decoded
+# image, the config and the preprocessed template side (TemplateState) with
+# its contours, Hu moments and shape values. Template.load maps a fresh .vvt
+# read-only instead of parsing and decoding, every process loading the same
+# template shares its pages. Run from src/ like the other scripts:
+#   python template_store.py ../templates/            compile what changed
+#   python template_store.py ../templates/ --watch    and keep watching
+#
+# Layout: MAGIC, the header length as uint64, the JSON header, then every
+# array at a 64 byte aligned offset listed in the header.
+
+MAGIC = b"VVTPL\x00\x00\x01"
+EXTENSION = ".vvt"
+ALIGN = 64
+IMAGES = ("img", "blur_img", "color_mask", "color_img", "filtered_img")
+
+
+class NoSource:
+    # The compiler only preprocesses the template image, it never reads frames
+    ended = False
+
+    def release(self):
+        pass
+
+
+class StoredTemplate:
+    # What a .vvt holds, arrays are read-only views of the mapped file
+    def __init__(self, header, arrays):
+        self.header = header
+        self.config = header["config"]
+        self.digest = header["digest"]
+        self.img = arrays["img"]
+        # Config values of TemplateCache.keys the state was compiled with
+        self.values = tuple(header["values"])
+        self.state = StoredState(header, arrays)
+
+
+class StoredState:
+    # Stands in for TemplateState
+    def __init__(self, header, arrays):
+        self.blur_img     = arrays["blur_img"]
+        self.color_mask   = arrays["color_mask"]
+        self.color_img    = arrays["color_img"]
+        self.filtered_img = arrays["filtered_img"]
+        ends = np.cumsum(arrays["counts"]).tolist()
+        points = arrays["points"]
+        self.contours = tuple(points[start:end] for start, end in zip([0] + ends[:-1], ends))
+
+        self.area      = header["area"]
+        self.perimeter = header["perimeter"]
+        self.center    = tuple(header["center"])
+        self.hu        = arrays["hu"]
+        self.aspect    = header["aspect"]
+        self.solidity  = header["solidity"]
+
+
+def sources(name):
+    # Modification time and size of the files a template is compiled from
+    stats = dict()
+    for ext in (".png", ".config"):
+        try:
+            stat = os.stat(name+ext)
+        except OSError:
+            return None
+        stats[ext] = [stat.st_mtime_ns, stat.st_size]
+    return stats
+
+
+def read_header(path):
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a compiled template: "+path)
+        length, = struct.unpack("<Q", file.read(8))
+        return json.loads(file.read(length))
+
+
+def stale(name):
+    current = sources(name)
+    if current is None:
+        return False
+    try:
+        return read_header(name+EXTENSION)["sources"] != current
+    except (OSError, ValueError):
+        return True
+
+
+def load(name):
+    # StoredTemplate of a .vvt newer than its sources, else None
+    path = name+EXTENSION
+    try:
+        header = read_header(path)
+    except (OSError, ValueError):
+        return None
+    if header["sources"] != sources(name):
+        return None
+    with open(path, "rb") as file:
+        data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = dict()
+    for key, (offset, dtype, shape) in header["arrays"].items():
+        count = int(np.prod(shape))
+        arrays[key] = np.frombuffer(data, dtype, count, offset).reshape(shape)
+    return StoredTemplate(header, arrays)
+
+
+def compile_template(name):
+    from pipeline import StageApp
+    from valu_vision import Template, TemplateCache, TemplateState, TemplateTracker
+
+    stats = sources(name)
+    template = Template()
+    template.read_text(name)
+    tracker = TemplateTracker(StageApp({}), template, NoSource())
+    state = TemplateState(tracker, template.img)
+
+    contours = state.contours
+    arrays = {key: getattr(state, key) for key in IMAGES[1:]}
+    arrays["img"] = template.img
+    arrays["points"] = np.concatenate(contours) if contours else np.zeros((0, 1, 2), np.int32)
+    arrays["counts"] = np.array([len(c) for c in contours], np.int64)
+    arrays["hu"] = np.asarray(state.hu, np.float64)
+
+    header = {"name": os.path.basename(name),
+              "sources": stats,
+              "config": template.config,
+              "values": [template.config[k] for k in TemplateCache.keys],
+              "digest": hashlib.sha1(template.img.tobytes()).hexdigest(),
+              "area": float(state.area), "perimeter": float(state.perimeter),
+              "center": [int(v) for v in state.center],
+              "aspect": float(state.aspect), "solidity": float(state.solidity),
+              "arrays": dict()}
+
+    # Offsets depend on the header length and the header lists the offsets,
+    # reserve room for them first
+    arrays = {key: np.ascontiguousarray(value) for key, value in arrays.items()}
+    for key, value in arrays.items():
+        header["arrays"][key] = [0, value.dtype.str, list(value.shape)]
+    start = len(MAGIC) + 8 + len(json.dumps(header)) + 32 * len(arrays)
+    offset = (start + ALIGN - 1) // ALIGN * ALIGN
+    for key, value in arrays.items():
+        header["arrays"][key][0] = offset
+        offset = (offset + value.nbytes + ALIGN - 1) // ALIGN * ALIGN
+    encoded = json.dumps(header).encode()
+    if len(MAGIC) + 8 + len(encoded) > min(v[0] for v in header["arrays"].values()):
+        raise ValueError("header of "+name+" doesn't fit")
+
+    # Written next to the old one and swapped in, a loading process sees
+    # either the old or the new file
+    path = name+EXTENSION
+    with open(path+".tmp", "wb") as file:
+        file.write(MAGIC + struct.pack("<Q", len(encoded)) + encoded)
+        for key, value in arrays.items():
+            file.seek(header["arrays"][key][0])
+            file.write(value.tobytes())
+    os.replace(path+".tmp", path)
+    return path
+
+
+def template_names(directory):
+    # Every name.png with a name.config next to it
+    names = list()
+    for entry in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(entry)
+        if ext == ".png" and os.path.exists(os.path.join(directory, name+".config")):
+            names.append(os.path.join(directory, name))
+    return names
+
+
+def compile_directory(directory, force=False):
+    compiled = list()
+    for name in template_names(directory):
+        if not force and not stale(name):
+            continue
+        try:
+            compiled.append(compile_template(name))
+        except Exception as e:
+            # A half saved config or image, the next scan tries again
+            print("Compiling", name, "failed:", e)
+    return compiled
+
+
+class TemplateWatcher:
+    # Recompiles the templates of a directory when a PNG or config changes,
+    # polled every interval seconds on its own thread
+    def __init__(self, directory, interval=2.0):
+        self.directory = directory
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="template_watcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            for path in compile_directory(self.directory):
+                print("Compiled", path)
+            if self.stop_event.wait(self.interval):
+                return
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(self.interval + 1.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compile templates into memory-mapped .vvt files")
+    parser.add_argument("directory", nargs="?", default="../templates/")
+    parser.add_argument("--force", action="store_true", help="also compile templates that didn't change")
+    parser.add_argument("--watch", action="store_true", help="keep recompiling templates that change")
+    parser.add_argument("--interval", type=float, default=2.0, help="seconds between scans with --watch")
+    args = parser.parse_args(argv)
+
+    for path in compile_directory(args.directory, args.force):
+        print("Compiled", path)
+    if args.watch:
+        watcher = TemplateWatcher(args.directory, args.interval)
+        try:
+            while True:
+                time.sleep(1.0)
+        except KeyboardInterrupt:
+            watcher.stop()
+
+
+if __name__ == "__main__":
+    main()
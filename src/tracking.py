@@ -0,0 +1,230 @@
+from collections import deque
+import numpy as np
+
+
+class Track:
+    def __init__(self, id, position, velocity, hits, misses, payload):
+        self.id = id
+        self.position = self.x, self.y = position
+        self.velocity = velocity
+        self.hits = hits
+        self.misses = misses
+        self.payload = payload
+
+    def __repr__(self):
+        return "[Track "+str(self.id)+"|"+str(self.x)+":"+str(self.y)+";"+str(self.hits)+"/"+str(self.misses)+"]"
+
+
+class MultiObjectTracker:
+    # Constant velocity Kalman filter per track, all tracks stepped together as
+    # arrays. Detections are assigned greedily on the distance to the predicted
+    # positions, only within gate pixels. Tracks are reported once they were
+    # seen min_hits times and dropped after max_misses frames without detection.
+    def __init__(self, gate=50, max_misses=5, min_hits=2, process_noise=1.0, measurement_noise=4.0):
+        self.gate = gate
+        self.max_misses = max_misses
+        self.min_hits = min_hits
+        self.q = process_noise
+        self.r = measurement_noise
+
+        self.X = np.zeros((0, 4))       # x, y, vx, vy
+        self.P = np.zeros((0, 4, 4))
+        self.ids = np.zeros(0, int)
+        self.hits = np.zeros(0, int)
+        self.misses = np.zeros(0, int)
+        self.payloads = list()
+
+        self.next_id = 1
+        self.last_time = None
+
+        self.H = np.array([[1., 0, 0, 0], [0, 1., 0, 0]])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def update(self, positions, payloads=None, timestamp=None):
+        positions = np.asarray(positions, np.float64).reshape(-1, 2)
+        if payloads is None:
+            payloads = [None] * len(positions)
+
+        # Frames without timestamps are one time unit apart. A repeated
+        # timestamp is the same frame again, nothing moved since.
+        dt = 1.0
+        if timestamp is not None:
+            dt = 0.0
+            if self.last_time is not None and timestamp > self.last_time:
+                dt = timestamp - self.last_time
+            self.last_time = timestamp
+
+        if dt > 0:
+            self.predict(dt)
+        rows, cols = self.assign(positions)
+        self.correct(rows, positions[cols])
+
+        self.misses += 1
+        self.misses[rows] = 0
+        self.hits[rows] += 1
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            self.payloads[r] = payloads[c]
+
+        # Drop lost tracks, start new ones from unassigned detections
+        keep = self.misses <= self.max_misses
+        if not keep.all():
+            self.X, self.P = self.X[keep], self.P[keep]
+            self.ids, self.hits, self.misses = self.ids[keep], self.hits[keep], self.misses[keep]
+            self.payloads = [p for p, k in zip(self.payloads, keep.tolist()) if k]
+
+        new = np.ones(len(positions), bool)
+        new[cols] = False
+        self.spawn(positions[new], [p for p, n in zip(payloads, new.tolist()) if n])
+
+        return self.tracks()
+
+    def tracks(self):
+        confirmed = np.flatnonzero(self.hits >= self.min_hits).tolist()
+        return [Track(int(self.ids[i]), (int(round(self.X[i, 0])), int(round(self.X[i, 1]))),
+                      (float(self.X[i, 2]), float(self.X[i, 3])), int(self.hits[i]), int(self.misses[i]),
+                      self.payloads[i]) for i in confirmed]
+
+    def predict(self, dt):
+        if not len(self.X):
+            return
+        F = np.eye(4)
+        F[0, 2] = F[1, 3] = dt
+        # Piecewise white acceleration noise
+        q = self.q * np.array([[dt**4 / 4, 0, dt**3 / 2, 0],
+                               [0, dt**4 / 4, 0, dt**3 / 2],
+                               [dt**3 / 2, 0, dt**2, 0],
+                               [0, dt**3 / 2, 0, dt**2]])
+        self.X = self.X @ F.T
+        self.P = F @ self.P @ F.T + q
+
+    def assign(self, positions):
+        # Greedy nearest pairs inside the gate, cheapest pair first
+        if not len(self.X) or not len(positions):
+            return np.zeros(0, int), np.zeros(0, int)
+
+        d = np.linalg.norm(self.X[:, None, :2] - positions[None, :, :], axis=2)
+        rows, cols = np.nonzero(d < self.gate)
+        order = np.argsort(d[rows, cols], kind="stable")
+
+        used_rows, used_cols = set(), set()
+        pairs_r, pairs_c = list(), list()
+        for r, c in zip(rows[order].tolist(), cols[order].tolist()):
+            if r in used_rows or c in used_cols:
+                continue
+            used_rows.add(r)
+            used_cols.add(c)
+            pairs_r.append(r)
+            pairs_c.append(c)
+
+        return np.array(pairs_r, int), np.array(pairs_c, int)
+
+    def correct(self, rows, z):
+        if not len(rows):
+            return
+        H = self.H
+        P = self.P[rows]
+        S = H @ P @ H.T + self.r * np.eye(2)
+        K = P @ H.T @ np.linalg.inv(S)
+        y = z - self.X[rows, :2]
+        self.X[rows] += np.einsum("nij,nj->ni", K, y)
+        self.P[rows] = (np.eye(4) - K @ H) @ P
+
+    def spawn(self, positions, payloads):
+        n = len(positions)
+        if not n:
+            return
+        X = np.zeros((n, 4))
+        X[:, :2] = positions
+        P = np.tile(np.diag([self.r, self.r, 100., 100.]), (n, 1, 1))
+
+        self.X = np.vstack([self.X, X])
+        self.P = np.concatenate([self.P, P])
+        self.ids = np.concatenate([self.ids, np.arange(self.next_id, self.next_id + n)])
+        self.hits = np.concatenate([self.hits, np.ones(n, int)])
+        self.misses = np.concatenate([self.misses, np.zeros(n, int)])
+        self.payloads.extend(payloads)
+        self.next_id += n
+
+
+class VoteAccumulator:
+    # Votes of the candidates of the last window frames, binned on their
+    # position. Every frame adds its votes and removes those of the frame
+    # leaving the window, each in O(1), and the bin with most votes wins, ties
+    # going to the smallest mean distance. Memory is bounded by window times
+    # max_candidates whatever the uptime.
+    def __init__(self, window=5, bin_size=4, max_candidates=64):
+        self.window = window
+        self.bin_size = bin_size
+        self.max_candidates = max_candidates
+
+        self.frames = deque()
+        self.counts = dict()        # bin -> votes
+        self.distances = dict()     # bin -> sum of distances
+        self.latest = dict()        # bin -> last candidate seen there
+        self.buckets = dict()       # votes -> bins with that many votes
+        self.top = 0
+
+    def key(self, obj):
+        return obj.x // self.bin_size, obj.y // self.bin_size
+
+    def update(self, candidates):
+        if len(candidates) > self.max_candidates:
+            candidates = sorted(candidates, key=lambda c: c.distance)[:self.max_candidates]
+
+        votes = list()
+        for c in candidates:
+            k = self.key(c)
+            self.increment(k, c.distance)
+            self.latest[k] = c
+            votes.append((k, c.distance))
+        self.frames.append(votes)
+
+        if len(self.frames) > self.window:
+            for k, d in self.frames.popleft():
+                self.decrement(k, d)
+
+        return self.winner()
+
+    def increment(self, k, distance):
+        n = self.counts.get(k, 0)
+        if n:
+            self.move(k, n, n + 1)
+        else:
+            self.buckets.setdefault(1, set()).add(k)
+            self.distances[k] = 0.0
+        self.counts[k] = n + 1
+        self.distances[k] += distance
+        if n + 1 > self.top:
+            self.top = n + 1
+
+    def decrement(self, k, distance):
+        n = self.counts[k]
+        if n > 1:
+            self.move(k, n, n - 1)
+            self.counts[k] = n - 1
+            self.distances[k] -= distance
+        else:
+            self.buckets[1].discard(k)
+            if not self.buckets[1]:
+                del self.buckets[1]
+            del self.counts[k], self.distances[k], self.latest[k]
+        # Counts only change by one, so the top drops by one at most
+        if self.top not in self.buckets:
+            self.top -= 1
+
+    def move(self, k, old, new):
+        self.buckets[old].discard(k)
+        if not self.buckets[old]:
+            del self.buckets[old]
+        self.buckets.setdefault(new, set()).add(k)
+
+    def winner(self):
+        if not self.top:
+            return None
+        best = min(self.buckets[self.top], key=lambda k: self.distances[k] / self.counts[k])
+        return self.latest[best]
+
+    def clear(self):
+        self.__init__(self.window, self.bin_size, self.max_candidates)
@@ -1,125 +1,438 @@
 import cv2
+import hashlib
+import json
 import paho.mqtt.client
+import queue
+import threading
+import time
+from collections import deque
 from operator import itemgetter
 import numpy as np
 
+import template_store
+import wire
+from capture import open_source
+from buffers import BufferPool
+from metrics import Metrics
+from pipeline import Pipeline
+from preview import Preview
+from tracking import MultiObjectTracker
+from shape_match import ContourBatch, RejectionCascade, min_rect_aspect, contour_solidity
+
 class App:
-    def __init__(self):
+    def __init__(self, source=None, overrides=None, events=None):
 
         self.setup()
+        # A supervisor worker runs with its own camera and topics
+        if overrides:
+            self.settings.update(overrides)
+        # Queue back to the supervisor for metrics and the loaded template
+        self.events = events
+
+        # Frame source of every tracker for the App's whole lifetime, opened
+        # with the first template unless one is handed in
+        self.source = source
+
+        # Filled from the MQTT network thread, drained by the main loop
+        self.inbox         = deque(maxlen=self.settings.get("inbox_size", 32))
+        self.inbox_dropped = 0
+        # Wakes the main loop when it has no frames to work on, see idle
+        self.inbox_cond    = threading.Condition()
 
         self.mqtt         = MQTT_Client(self)
+        self.publisher    = ResultPublisher(self.mqtt,
+                                            self.settings.get("pub_deadband", 2),
+                                            self.settings.get("pub_max_rate", 10.0),
+                                            self.settings.get("pub_heartbeat", 5.0),
+                                            self.settings.get("pub_top_k", 1),
+                                            self.settings.get("wire_format", "text"))
 
-        self.cycle     = 0
-        self.pub_freq  = 10
         self.tracker   = None
+        self.pipeline  = None
+        # Trackers built on a thread by load_template, swapped in between frames
+        self.loaded         = queue.Queue()
+        self.load_count     = 0
+        self.swap_received  = None
+        # Tuning commands that arrive while a template loads are for that
+        # template, they wait for the swap, see release_tuning
+        self.loading        = False
+        self.held           = list()
         self.quit      = False
-        self.payload   = None
         self.template  = None
         self.state     = "standby"
 
+        # Stable ids for the matches over time, see track_objects
+        self.objects = None
+        self.tracks  = list()
+        if self.settings.get("track_objects", 0):
+            self.objects = MultiObjectTracker(self.settings.get("track_gate", 50),
+                                              self.settings.get("track_max_misses", 5),
+                                              self.settings.get("track_min_hits", 2))
+
+        # Stage latency histograms published on metrics_topic, see report_metrics
+        self.metrics = None
+        if self.settings.get("metrics", 0):
+            self.metrics = Metrics(self.settings.get("metrics_interval", 10.0))
+        self.metrics_topic = self.settings.get("metrics_topic") or self.settings["output_topic"]+"/metrics"
+        # Replies to the tuning commands, see tune
+        self.tuning_topic = self.settings.get("tuning_topic") or self.settings["output_topic"]+"/tuning"
+
+        # Recompiles changed templates, see template_store.py. A supervisor
+        # runs one for all its workers.
+        self.watcher = None
+        if self.settings.get("template_watch", 0) and not events:
+            self.watcher = template_store.TemplateWatcher(self.settings["template_filepath"],
+                                                          self.settings["template_watch"])
+
         # Debugging Tools
         self.show_stream = True
+        # No windows at all on boxes without a display, the preview is the
+        # way to look at the line there
+        self.headless = self.settings.get("headless", 0)
+        self.preview = None
+        if self.settings.get("preview_file") or self.settings.get("preview_port", 0):
+            self.preview = Preview(self.settings.get("preview_fps", 2.0), self.settings.get("preview_file", ""),
+                                   self.settings.get("preview_port", 0), draw_matches)
+
+        # A restarted worker picks up the template it was tracking
+        if self.settings.get("startup_template"):
+            self.inbox.append((time.perf_counter(), ["load", self.settings["startup_template"]]))
 
     #---------------------------------------------------------------------------
     #Program Control Flow
     #---------------------------------------------------------------------------
 
     def setup(self):
-        self.settings = dict()
-        cast_int = ["camera_number","port"]
-        with open("../settings.txt","r") as file:
-            for line in file:
-                if line[0] == "#" or line[0] == "":
-                    continue
-                line = line.rstrip().split("=")
-                if line[0] in cast_int:
-                    self.settings[line[0]] = int(line[1])
-                else:
-                    self.settings[line[0]] = line[1]
+        self.settings = read_settings()
         print(self.settings)
 
     def save_settings(self):
         with open("../settings.txt","w") as file:
             for key in self.settings:
-                file.write(key+"="+str(self.settings[key])+"\n")
+                value = self.settings[key]
+                if isinstance(value, list):
+                    value = ",".join(str(v) for v in value)
+                file.write(key+"="+str(value)+"\n")
 
     def main_loop(self):
 
         while not self.quit:
+            t = time.perf_counter()
             self.process_inbox()
+            self.swap_template()
+            t = self.measure("inbox", t)
+
+            if self.state == "standby":
+                self.idle(0.1)
 
             if self.state == "setup":
                 self.tracker.update()
-                self.tracker.update_trackbars()
                 self.tracker.render()
 
+            if self.tracker and self.tracker.cam.ended:
+                print("End of recording")
+                self.shutdown()
+
             if self.state == "tracking":
                 matches = self.tracker.update()
+                t = self.measure(None, t)
+                if self.swap_received is not None and self.tracker.tracked:
+                    self.report_swap()
+                self.track_objects(matches)
+                t = self.measure("tracking", t)
                 self.tracker.show()
+                if self.preview:
+                    self.preview.offer(self.tracker.img, matches)
+                t = self.measure("render", t)
                 self.publish_result(matches)
+                self.measure("publish", t)
+                self.report_metrics()
+
 
 
 
+    def idle(self, timeout):
+        # Nothing to track, sleep until a command or a loaded template arrives
+        with self.inbox_cond:
+            if not self.inbox and self.loaded.empty():
+                self.inbox_cond.wait(timeout)
+
+    def track_objects(self, matches):
+        if not self.objects:
+            return
+        matches = matches or []
+        # Frame numbers, the filter's noise is tuned for steps of one frame.
+        # A repeated frame keeps its number and predicts no motion.
+        self.tracks = self.objects.update([m[0] for m in matches], matches, self.tracker.frame_seq)
+
+    def measure(self, stage, start):
+        # Time since start into the stage histogram, None for the pipeline
+        # stages of the last tracker update
+        now = time.perf_counter()
+        if self.metrics:
+            if stage is None:
+                self.metrics.record_stages(self.tracker.stage_times)
+                self.metrics.frame()
+            else:
+                self.metrics.record(stage, now - start)
+        return now
+
+    def report_swap(self):
+        # Template command received to first frame tracked with the template
+        latency = time.perf_counter() - self.swap_received
+        self.swap_received = None
+        print("Tracking", self.tracker.template.name, "after %.1f ms" % (latency * 1000))
+        if self.metrics:
+            self.metrics.record("template_swap", latency)
+            self.metrics.gauge("template_swap_ms", round(latency * 1000, 3))
+
+    def report_metrics(self):
+        if not self.metrics or not self.metrics.due():
+            return
+        self.metrics.gauge("inbox_dropped", self.inbox_dropped)
+        capture = self.tracker.cam.stats()
+        self.metrics.gauge("capture_dropped", capture["dropped"])
+        self.metrics.gauge("capture_duplicates", capture["duplicates"])
+        self.metrics.gauge("published", self.publisher.sent)
+        self.metrics.gauge("suppressed", self.publisher.suppressed)
+        for name, value in self.tracker.stats().items():
+            self.metrics.gauge(name, value)
+        window = self.metrics.take()
+        self.mqtt.publish(json.dumps(Metrics.summarize(window), separators=(",", ":")), self.metrics_topic)
+        if self.events:
+            self.events.put(("metrics", self.settings["camera_number"], window))
 
     def shutdown(self):
         print("quitting...")
         self.quit = True
-        cv2.destroyAllWindows()
+        if self.pipeline:
+            self.pipeline.stop()
+        if self.preview:
+            self.preview.stop()
+        if self.watcher:
+            self.watcher.stop()
+        self.mqtt.stop()
+        if self.source:
+            self.source.release()
+        if not self.headless:
+            cv2.destroyAllWindows()
         quit()
 
     #---------------------------------------------------------------------------
     # communication
     #---------------------------------------------------------------------------
     def publish_result(self, matches):
-        self.cycle += 1
-        if self.cycle >= self.pub_freq:
-            self.cycle = 0
-            if matches:
-                msg = str(matches[0][0][0])+";"+str(matches[0][0][1])
-            else:
-                msg = "Nothing Found"
-            print("Sending:",msg)
-            self.mqtt.publish(msg)
+        self.publisher.update(matches, self.tracker.frame_seq, self.tracker.frame_time,
+                              wire.template_id(self.tracker.template.name))
 
     def receive(self, msg):
-        self.payload = str(msg)[2:-1].split(";")
-        return
+        # Called on the MQTT network thread, only hand the command over
+        with self.inbox_cond:
+            if len(self.inbox) == self.inbox.maxlen:
+                self.inbox_dropped += 1
+            self.inbox.append((time.perf_counter(), str(msg)[2:-1].split(";")))
+            self.inbox_cond.notify()
 
     def process_inbox(self):
-        self.mqtt.update()
-        if self.payload:
-            if self.payload[0] == "quit":
+        if self.metrics:
+            self.metrics.peak("inbox_depth", len(self.inbox))
+        commands = list()
+        while self.inbox:
+            commands.append(self.inbox.popleft())
+
+        for received, payload in self.coalesce(commands):
+            if payload[0] == "quit":
                 self.shutdown()
 
-            elif self.payload[0] == "new":
-                self.new_template(self.payload[1])
+            elif payload[0] == "new":
+                self.new_template(payload[1])
 
-            elif self.payload[0] == "load":
-                self.load_template(self.payload[1])
+            elif payload[0] == "load":
+                self.load_template(payload[1], received)
 
+            elif payload[0] in ("get", "set", "patch", "snapshot", "save"):
+                if self.loading:
+                    self.held.append(payload)
+                else:
+                    self.tune(payload)
+
+    def coalesce(self, commands):
+        # Only the last template command of a batch matters, the ones before
+        # would be replaced before a single frame is tracked
+        for i, command in enumerate(commands):
+            if command[1][0] == "quit":
+                # Tuning before the quit still runs, a save most of all. A
+                # template would only be loaded to quit.
+                return [c for c in commands[:i] if c[1][0] not in ("new", "load")] + [command]
 
-            self.payload = None
+        template_commands = [i for i, (_, payload) in enumerate(commands) if payload[0] in ("new", "load")]
+        if len(template_commands) > 1:
+            last = template_commands[-1]
+            commands = [command for i, command in enumerate(commands) if i not in template_commands or i == last]
+
+        return commands
 
     def new_template(self, img_path):
         print("Setting up new template with image:",img_path)
+        if self.pipeline:
+            print("Template setup needs pipeline=0")
+            return
+        if self.headless:
+            print("Template setup needs a display, headless=0")
+            return
         #TODO check if file exists
         tem = Template()
         tem.new(self.settings["template_filepath"]+img_path)
-        if self.tracker:
-            del self.tracker
-        self.tracker = TemplateTracker(self,tem)
+        # A template still loading would replace the setup
+        self.load_count += 1
+        self.loading = False
+        self.tracker = TemplateTracker(self, tem, self.frame_source())
         self.tracker.live_init()
         self.state = "setup"
+        self.release_tuning()
+
+    def frame_source(self):
+        if self.source is None:
+            self.source = open_source(self.settings)
+        return self.source
 
-    def load_template(self, tem_name):
+    def load_template(self, tem_name, received=None):
         print("Loading template",tem_name)
-        tem = Template()
-        tem.load(self.settings["template_filepath"]+tem_name)
-        if self.tracker:
-            del self.tracker
-        self.tracker = TemplateTracker(self, tem)
+        if self.settings.get("pipeline", 0):
+            self.load_pipeline(tem_name, received)
+            return
+        # Built on a thread while the current template keeps tracking, a
+        # newer load makes this one stale
+        self.load_count += 1
+        self.loading = True
+        source = self.frame_source()
+        threading.Thread(target=self.build_tracker, name="load_template", daemon=True,
+                         args=(tem_name, self.load_count, source, received)).start()
+
+    def build_tracker(self, tem_name, count, source, received):
+        try:
+            tem = Template()
+            tem.load(self.settings["template_filepath"]+tem_name)
+            tracker = TemplateTracker(self, tem, source)
+            # Preprocess the template side here, not on the first frame
+            tracker.template_cache.get(tem)
+        except Exception as e:
+            print("Loading template", tem_name, "failed:", e)
+            tracker = None
+        self.loaded.put((count, tem_name, tracker, received))
+        with self.inbox_cond:
+            self.inbox_cond.notify()
+
+    def swap_template(self):
+        # Between two frames, only the newest load is swapped in
+        ready = None
+        try:
+            while True:
+                done = self.loaded.get_nowait()
+                if done[0] == self.load_count:
+                    ready = done
+        except queue.Empty:
+            pass
+        if ready is None:
+            return
+        _, tem_name, tracker, received = ready
+        self.loading = False
+        if tracker is None:
+            # The current template keeps tracking
+            self.release_tuning("loading "+tem_name+" failed")
+            return
+        if self.state == "setup" and not self.headless:
+            cv2.destroyAllWindows()
+        self.tracker = tracker
         self.state = "tracking"
+        self.swap_received = received
+        if self.events:
+            self.events.put(("template", self.settings["camera_number"], tem_name))
+        self.release_tuning()
+
+    def release_tuning(self, error=None):
+        # Tuning commands held while a template loaded, for the template now
+        # in place or answered with the error of a failed load
+        held, self.held = self.held, list()
+        for payload in held:
+            if error:
+                self.reply({"command": payload[0], "error": error})
+            else:
+                self.tune(payload)
+
+    def tune(self, payload):
+        # Template config over MQTT, replies as JSON on tuning_topic:
+        #   get                      all keys, get;Key for one
+        #   set;Key;Value            one key
+        #   patch;Key=Value;Key=...  several keys, none if one is invalid
+        #   snapshot;View            render() view 0-4 of the last frame as
+        #                            JPEG on tuning_topic/snapshot/View
+        #   save                     the config file
+        # Only changed values reprocess anything, the template cache and the
+        # change gate key on them.
+        command = payload[0]
+        if not self.tracker or self.pipeline:
+            self.reply({"command": command, "error": "no template" if not self.pipeline else "needs pipeline=0"})
+            return
+        template = self.tracker.template
+
+        if command == "snapshot":
+            view = int(payload[1]) if len(payload) > 1 and payload[1].isdigit() else self.tracker.view
+            jpeg = self.tracker.snapshot(view)
+            if jpeg is None:
+                self.reply({"command": command, "error": "no frame"})
+                return
+            self.mqtt.publish(jpeg, self.tuning_topic+"/snapshot/"+str(view))
+            return
+
+        if command == "save":
+            template.save_config()
+            self.reply({"command": command, "saved": template.config_file, "version": template.version})
+            return
+
+        if command == "get":
+            keys = payload[1:] if len(payload) > 1 and payload[1] else list(template.config)
+            unknown = [k for k in keys if k not in template.config]
+            if unknown:
+                self.reply({"command": command, "error": "unknown keys", "keys": unknown})
+                return
+            self.reply({"command": command, "template": template.name, "version": template.version,
+                        "config": {k: template.config[k] for k in keys}})
+            return
+
+        if command == "set":
+            values = {payload[1]: payload[2]} if len(payload) > 2 else dict()
+        else:
+            values = dict(item.split("=", 1) for item in payload[1:] if "=" in item)
+        try:
+            values = template.check(values)
+        except ValueError as e:
+            self.reply({"command": command, "error": str(e)})
+            return
+        changed = [key for key, value in values.items() if template.set(key, value)]
+        if changed and self.state == "setup":
+            self.tracker.sync_trackbars()
+        self.reply({"command": command, "changed": changed, "version": template.version,
+                    "config": {k: template.config[k] for k in values}})
+
+    def reply(self, message):
+        self.mqtt.publish(json.dumps(message, separators=(",", ":")), self.tuning_topic)
+
+    def load_pipeline(self, tem_name, received=None):
+        # Stage processes keep running, they only switch templates
+        if not self.pipeline:
+            self.pipeline = Pipeline(self.settings)
+        try:
+            self.pipeline.load(tem_name)
+        except Exception as e:
+            # The stages keep tracking the current template
+            print("Loading template", tem_name, "failed:", e)
+            return
+        self.tracker = self.pipeline
+        self.state = "tracking"
+        self.swap_received = received
+        if self.events:
+            self.events.put(("template", self.settings["camera_number"], tem_name))
 
     def exit_key(self):
         k = cv2.waitKey(5) % 0xFF
@@ -136,18 +449,23 @@ class MQTT_Client:
         self.input_topic  = app.settings["input_topic"]
         self.output_topic = app.settings["output_topic"]
 
+        self.client.on_connect    = self.on_connect
         self.client.on_message    = self.on_message
         self.client.on_subscribe  = self.on_subscribe
         self.client.on_disconnect = self.on_disconnect
 
 
         self.client.connect(app.settings["broker"], app.settings["port"], 60)
-        self.client.subscribe(self.input_topic)
+        # Network I/O runs on paho's own thread, reconnects included
+        self.client.loop_start()
         print("MQTT client initiated")
 
+    def on_connect(self, client, userdata, flags, rc):
+        # (Re)subscribe on every connect so a reconnect keeps the subscription
+        self.client.subscribe(self.input_topic)
+
     def on_disconnect(self, client, userdata, rc):
         print("disconnected")
-        self.client.reconnect()
 
     def on_message(self, client, userdata, msg):
         self.master.receive(msg.payload)
@@ -155,22 +473,85 @@ class MQTT_Client:
     def on_subscribe(self, client, userdata, mid, granted_qos):
         print("Subscribed to:", client, userdata, mid, granted_qos)
 
-    def update(self):
-        self.client.loop(0.1)
-
-    def publish(self, msg):
-        self.client.publish(self.output_topic, str(msg))
+    def publish(self, msg, topic=None):
+        if not isinstance(msg, bytes):
+            msg = str(msg)
+        self.client.publish(topic or self.output_topic, msg)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class ResultPublisher:
+    # Publishes when the detections change instead of every n-th frame: a
+    # match appears or disappears, or one moves further than deadband pixels.
+    # Never more often than max_rate per second, and at least every heartbeat
+    # seconds so consumers know the tracker is alive. Sends the top_k matches
+    # with the smallest shape distance, as text or as wire.encode() records.
+    def __init__(self, mqtt, deadband=2, max_rate=10.0, heartbeat=5.0, top_k=1, wire_format="text"):
+        self.mqtt      = mqtt
+        self.binary    = wire_format == "binary"
+        self.deadband  = deadband
+        self.min_gap   = 1.0 / max_rate if max_rate else 0.0
+        self.heartbeat = heartbeat
+        self.top_k     = top_k
+
+        self.published  = None
+        # Monotonic, a wall clock stepped back by NTP would hold every publish
+        self.last_time  = None
+        self.sent       = 0
+        self.suppressed = 0
+
+    def update(self, matches, seq=0, timestamp=0.0, template=0, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        best = sorted(matches or [], key=itemgetter(2))[:self.top_k]
+        positions = [m[0] for m in best]
+        since = float("inf") if self.last_time is None else now - self.last_time
+        due = self.changed(positions) or since >= self.heartbeat
+        if not due or since < self.min_gap:
+            # A pending change stays pending until the rate allows it
+            self.suppressed += 1
+            return False
+
+        if self.binary:
+            self.mqtt.publish(wire.encode(best, seq, timestamp, template))
+        else:
+            msg = self.format(positions)
+            print("Sending:",msg)
+            self.mqtt.publish(msg)
+        self.published = positions
+        self.last_time = now
+        self.sent += 1
+        return True
+
+    def changed(self, positions):
+        if self.published is None or len(positions) != len(self.published):
+            return True
+        # Every match needs a published one within the deadband, order aside
+        left = list(self.published)
+        for x, y in positions:
+            near = [q for q in left if abs(q[0] - x) <= self.deadband and abs(q[1] - y) <= self.deadband]
+            if not near:
+                return True
+            left.remove(near[0])
+        return False
+
+    def format(self, positions):
+        if not positions:
+            return "Nothing Found"
+        if self.top_k == 1:
+            return str(positions[0][0])+";"+str(positions[0][1])
+        return ";".join(str(x)+","+str(y) for x, y in positions)
+
+    def stats(self):
+        return {"sent": self.sent, "suppressed": self.suppressed}
 
 
 class Template:
-    def __init__(self):
-        pass
-
-    def new(self, name):
-        self.name = name
-        self.config_file = name[:-4]+".config"
-        self.img = cv2.imread(name,cv2.IMREAD_COLOR)
-        self.config = {
+    defaults = {
         "BinaryLower"      : 100,
         "BinaryUpper"      : 255,
         "Blur"             : 0,
@@ -183,14 +564,67 @@ class Template:
         "MaxDistance"      : 20, # Is divided by 20 befor application
         "AreaFilter"       : 500,
         "PerimeterFilter"  : 500,
+        "AspectFilter"     : 0,  # Percent of the template aspect ratio, 0 is off
+        "SolidityFilter"   : 0,  # Percentage points of the template solidity, 0 is off
         "BinaryMethod"     : 1,
+        "PyramidLevel"     : 0,  # Search at 1/2**level resolution, refine at full
+        "ColorSpace"       : 0,  # 0 applies the HSV ranges to BGR like older templates, 1 to real HSV
+        }
+
+    # Lowest and highest value of every key, the trackbars end at the highest.
+    # Remote changes outside them are refused, see check.
+    limits = {
+        "BinaryLower"      : (0, 255),
+        "BinaryUpper"      : (0, 255),
+        "Blur"             : (0, 3),
+        "HueLower"         : (0, 255),
+        "HueUpper"         : (0, 255),
+        "SaturationLower"  : (0, 255),
+        "SaturationUpper"  : (0, 255),
+        "ValueLower"       : (0, 255),
+        "ValueUpper"       : (0, 255),
+        "MaxDistance"      : (0, 100),
+        "AreaFilter"       : (0, 2000),
+        "PerimeterFilter"  : (0, 2000),
+        "AspectFilter"     : (0, 100),
+        "SolidityFilter"   : (0, 100),
+        "BinaryMethod"     : (0, 2),
+        "PyramidLevel"     : (0, 4),
+        "ColorSpace"       : (0, 1),
         }
 
+    def __init__(self):
+        # Counts the config changes made through set()
+        self.version = 0
+        # template_store.StoredTemplate when loaded from a compiled template
+        self.compiled = None
+
+    def new(self, name):
+        self.name = name
+        self.config_file = name[:-4]+".config"
+        self.img = cv2.imread(name,cv2.IMREAD_COLOR)
+        self.config = dict(self.defaults)
+
     def load(self, name):
+        # The compiled template when it is newer than the PNG and config
+        self.compiled = template_store.load(name)
+        if self.compiled is None:
+            self.read_text(name)
+            return
+        self.name = name
+        self.config_file = name+".config"
+        self.config = dict(self.defaults, **self.compiled.config)
+        self.img = self.compiled.img
+
+    def read_text(self, name):
         self.name = name
-        self.config = dict()
+        self.config_file = name+".config"
+        # Older config files don't have every key yet
+        self.config = dict(self.defaults)
         self.config = self.read_config(self.name+".config")
         self.img = cv2.imread(self.name+".png",cv2.IMREAD_COLOR)
+        if self.img is None:
+            raise FileNotFoundError("no image "+self.name+".png")
 
     def read_config(self, path):
         with open(path,"r") as file:
@@ -198,11 +632,36 @@ class Template:
                 if line[0] == "#" or line[0] == "":
                     continue
                 line = line.rstrip().split("=")
-                print(line)
                 self.config[line[0]] = int(line[1])
 
         return self.config
 
+    def check(self, values):
+        # Values as ints within the limits of known keys, ValueError naming
+        # the first bad one
+        checked = dict()
+        if not values:
+            raise ValueError("no values")
+        for key, value in values.items():
+            if key not in self.defaults:
+                raise ValueError("unknown key "+key)
+            try:
+                checked[key] = int(value)
+            except ValueError:
+                raise ValueError("not an integer: "+key+"="+str(value))
+            lowest, highest = self.limits[key]
+            if not lowest <= checked[key] <= highest:
+                raise ValueError("out of range: "+key+"="+str(value)+", "+str(lowest)+" to "+str(highest))
+        return checked
+
+    def set(self, key, value):
+        # Whether the value changed, nothing is reprocessed for the same value
+        if self.config.get(key) == value:
+            return False
+        self.config[key] = value
+        self.version += 1
+        return True
+
     def get_hsv_lower(self):
         return self.config["HueLower"], self.config["SaturationLower"], self.config["ValueLower"]
 
@@ -216,56 +675,382 @@ class Template:
 
 
 
+class TemplateState:
+    def __init__(self, tracker, img):
+        self.blur_img, self.color_mask, self.color_img, self.filtered_img = tracker.preprocess(img)
+        self.contours = tracker.get_contour(self.filtered_img)
+
+        self.area      = 0
+        self.perimeter = 0
+        self.center    = (0, 0)
+        self.hu        = np.zeros(7)
+        self.aspect    = 0.0
+        self.solidity  = 0.0
+        if self.contours:
+            self.area      = cv2.contourArea(self.contours[0])
+            self.perimeter = cv2.arcLength(self.contours[0], True)
+            self.center    = tracker.get_center(self.contours[0])
+            self.hu        = cv2.HuMoments(cv2.moments(self.contours[0])).flatten()
+            self.aspect    = min_rect_aspect(self.contours[0])
+            self.solidity  = contour_solidity(self.contours[0])
+
+
+class TemplateCache:
+    # Config keys that change the template side of the pipeline. Distance and
+    # filter keys are applied per frame and don't invalidate the cache.
+    keys = ("Blur", "BinaryMethod", "BinaryLower", "BinaryUpper",
+            "HueLower", "HueUpper", "SaturationLower", "SaturationUpper",
+            "ValueLower", "ValueUpper", "ColorSpace")
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+        self.key     = None
+        self.state   = None
+        self.hits    = 0
+        self.misses  = 0
+        self.seeded  = 0
+
+        self.img_ref    = None
+        self.img_digest = None
+
+    def get(self, template):
+        values = tuple(template.config[k] for k in self.keys)
+        key = hash((self.image_digest(template),) + values)
+        if self.state is not None and key == self.key:
+            self.hits += 1
+            return self.state
+
+        self.misses += 1
+        compiled = template.compiled
+        if compiled is not None and compiled.img is template.img and compiled.values == values:
+            # Preprocessed by template_store.py with this config
+            self.seeded += 1
+            self.state = compiled.state
+        else:
+            self.state = TemplateState(self.tracker, template.img)
+        self.key = key
+        return self.state
+
+    def image_digest(self, template):
+        # Hashing the pixels is only worth it when a different image is handed
+        # in, a compiled template brings its hash along
+        img = template.img
+        if img is not self.img_ref:
+            self.img_ref = img
+            compiled = template.compiled
+            if compiled is not None and compiled.img is img:
+                self.img_digest = compiled.digest
+            else:
+                self.img_digest = hashlib.sha1(img.tobytes()).hexdigest()
+        return self.img_digest
+
+    def invalidate(self):
+        self.key   = None
+        self.state = None
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "seeded": self.seeded}
+
+
+class ChangeGate:
+    # Cheap test whether a frame differs from the last processed one. Frames
+    # are compared as small grayscale thumbnails, each pixel the mean of a
+    # block, so a single part moving still shows up while sensor noise averages
+    # out. A frame is processed anyway every refresh frames or when key changes.
+    def __init__(self, threshold=3, refresh=30, size=(64, 48)):
+        self.threshold = threshold
+        self.refresh   = refresh
+        self.size      = size
+
+        self.thumb   = None
+        self.key     = None
+        self.since   = 0
+        self.frames  = 0
+        self.skipped = 0
+
+    def changed(self, img, key=None):
+        self.frames += 1
+        thumb = cv2.resize(img, self.size, interpolation=cv2.INTER_AREA)
+        if thumb.ndim == 3:
+            thumb = cv2.cvtColor(thumb, cv2.COLOR_BGR2GRAY)
+
+        if (self.thumb is None or key != self.key or self.since >= self.refresh
+                or thumb.shape != self.thumb.shape
+                or cv2.norm(thumb, self.thumb, cv2.NORM_INF) > self.threshold):
+            self.thumb = thumb
+            self.key = key
+            self.since = 0
+            return True
+
+        self.since += 1
+        self.skipped += 1
+        return False
+
+    def skip_ratio(self):
+        if not self.frames:
+            return 0.0
+        return self.skipped / self.frames
+
+    def stats(self):
+        return {"frames": self.frames, "skipped": self.skipped, "skip_ratio": self.skip_ratio()}
+
+
 class TemplateTracker:
-    def __init__(self, app, template):
+    def __init__(self, app, template, source=None):
         self.app = app
         self.settings = app.settings
-        self.cam = cv2.VideoCapture(self.settings["camera_number"])
+        # The App owns the source and keeps it open across templates
+        self.cam = open_source(self.settings) if source is None else source
         self.template = template
         self.window = "Settings"
+        self.headless = self.settings.get("headless", 0)
+        self.syncing = False
         self.view = 4
         self.mock_img = np.zeros( (1,500,3), np.uint8)
 
         self.match_method = []
-
-    def __del__(self):
-        self.cam.release()
-        cv2.destroyAllWindows()
-
+        self.template_cache = TemplateCache(self)
+
+        order = self.settings.get("cascade_order")
+        self.cascade = RejectionCascade(order.split(",") if order else None)
+
+        # Region of interest around the last known position, see search_region
+        self.roi_mode    = self.settings.get("roi_mode", 0)
+        self.roi_margin  = self.settings.get("roi_margin", 64)
+        self.roi_refresh = self.settings.get("roi_refresh", 30)
+        self.roi         = None
+        self.roi_frames  = 0
+        self.roi_motion  = (0, 0)
+        self.roi_last    = None
+        self.roi_stats   = {"roi": 0, "full": 0}
+
+        # Border added around coarse pyramid candidates before refining them
+        self.pyramid_margin = self.settings.get("pyramid_margin", 16)
+
+        self.gate = None
+        if self.settings.get("change_gate", 0):
+            self.gate = ChangeGate(self.settings.get("gate_threshold", 3), self.settings.get("gate_refresh", 30))
+        self.f_matches = None
+        # Frames tracked with this template, see App.report_swap
+        self.tracked = 0
+
+        # Seconds spent per pipeline stage on the last frame, see benchmark.py
+        self.stage_times = dict()
+
+        # Per-frame images are written into these instead of new arrays, the
+        # camera reads into the last frame's array
+        self.buffers = BufferPool()
+        self.frame_buffer = None
+        self.img = None
+        # Until the source delivers its first frame
+        self.frame_seq = 0
+        self.frame_time = 0.0
+
+        # Gray value to binary table of band_lookup, rebuilt when its config changes
+        self.band_key = None
+        self.band_table = None
+        # BGR to binary bits of hsv_band_lookup, rebuilt when its config changes
+        self.hsv_key = None
+        self.hsv_table = None
 
     def update(self):
-        _, self.img = self.cam.read()
-
-        self.blur_img = self.blur(self.img)
-        self.t_blur_img = self.blur(self.template.img)
-
-
-        self.color_mask, self.color_img = self.color(self.blur_img)
-        self.t_color_mask, self.t_color_img = self.color(self.t_blur_img)
-
-        if self.template.config["BinaryMethod"] == 0:
-            self.filtered_img = self.binary_band(self.color_img)
-            self.t_filtered_img = self.binary_band(self.t_color_img)
-        elif self.template.config["BinaryMethod"] == 1:
-            self.filtered_img = self.binary_band_inv(self.color_img)
-            self.t_filtered_img = self.binary_band_inv(self.t_color_img)
-        elif self.template.config["BinaryMethod"] == 2:
-            self.filtered_img = cv2.Canny(self.color_img, self.template.config["BinaryLower"],self.template.config["BinaryUpper"])
-            self.t_filtered_img = cv2.Canny(self.t_color_img, self.template.config["BinaryLower"],self.template.config["BinaryUpper"])
-
-        self.contours = self.get_contour(self.filtered_img)
-        self.t_contours = self.get_contour(self.t_filtered_img)
+        start = time.perf_counter()
+        frame, frame_time, frame_seq = self.cam.read_frame(self.frame_buffer)
+        if frame is None:
+            # Nothing new from the source, keep the last result
+            return self.f_matches
+        self.img, self.frame_time, self.frame_seq = frame, frame_time, frame_seq
+        self.frame_buffer = frame
+        read = time.perf_counter()
+
+        if self.gate and self.app.state != "setup" and self.f_matches is not None:
+            # Static scene, the last result still holds
+            if not self.gate.changed(self.img, (id(self.template), self.template.version)):
+                now = time.perf_counter()
+                self.stage_times = {"read": read - start, "gate": now - read, "total": now - start}
+                return self.f_matches
+        gate = time.perf_counter()
+
+        # Template side only changes with the template config, see TemplateCache
+        state = self.template_cache.get(self.template)
+        # Started after the template so its preprocessing isn't counted as the frame's
+        self.stage_times = {"read": read - start, "gate": gate - read, "template": time.perf_counter() - gate}
+        self.t_blur_img     = state.blur_img
+        self.t_color_mask   = state.color_mask
+        self.t_color_img    = state.color_img
+        self.t_filtered_img = state.filtered_img
+        self.t_contours     = state.contours
+        if self.t_contours:
+            self.template.area = state.area
+            self.template.perimeter = state.perimeter
+
+        self.region = self.search_region()
+        level = self.template.config["PyramidLevel"]
+        if self.region is None and level and self.app.state != "setup":
+            self.contours = self.pyramid_contours(level)
+        else:
+            self.contours = self.region_contours(self.region)
+
+        self.f_matches = self.get_matches(self.contours, self.t_contours)
+        if self.app.state == "setup":
+            # Setup view 3 shows the shape matches before any filter
+            self.matches = self.get_matches(self.contours, self.t_contours, filters=False)
+        else:
+            self.matches = self.f_matches
+
+        self.track_region(self.f_matches)
+        self.tracked += 1
+
+        self.stage_times["total"] = time.perf_counter() - start
+        return self.f_matches
 
+    def stats(self):
+        # Counters for tuning as flat gauge names, see App.report_metrics
+        stats = {"template_cache_"+k: v for k, v in self.template_cache.stats().items()}
+        cascade = self.cascade.stats()
+        stats["cascade_contours"] = cascade["contours"]
+        for stage, rejected in cascade["rejected"].items():
+            stats["cascade_rejected_"+stage] = rejected
+        if self.gate:
+            stats.update({"gate_"+k: v for k, v in self.gate.stats().items()})
+            stats["gate_skip_ratio"] = round(stats["gate_skip_ratio"], 4)
+        if self.roi_mode:
+            stats.update({"roi_"+k: v for k, v in self.roi_stats.items()})
+        return stats
+
+    def search_region(self):
+        # Window to search in this frame, None for the full frame
+        if not self.roi_mode or self.roi is None or self.app.state == "setup":
+            self.roi_stats["full"] += 1
+            return None
+        if self.roi_frames >= self.roi_refresh:
+            # Look at the whole frame now and then so nothing new is missed
+            self.roi_frames = 0
+            self.roi_stats["full"] += 1
+            return None
+
+        self.roi_frames += 1
+        self.roi_stats["roi"] += 1
+        return self.roi
+
+    def track_region(self, matches):
+        if not self.roi_mode:
+            return
+        if not matches:
+            # Target lost, back to the full frame
+            self.roi = None
+            self.roi_last = None
+            return
 
-        self.matches = self.get_matches(self.contours, self.t_contours)
-        if self.t_contours:
-            self.template.area = cv2.contourArea(self.t_contours[0])
-            self.template.perimeter = cv2.arcLength(self.t_contours[0], True)
+        # Bounding box of everything found, shifted by the last motion and
+        # grown by the margin plus the motion so it still fits if it keeps moving
+        boxes = np.array([cv2.boundingRect(c) for p, c, d, a, l in matches])
+        x, y = boxes[:, 0].min(), boxes[:, 1].min()
+        w = (boxes[:, 0] + boxes[:, 2]).max() - x
+        h = (boxes[:, 1] + boxes[:, 3]).max() - y
+
+        center = (x + w // 2, y + h // 2)
+        if self.roi_last:
+            self.roi_motion = (center[0] - self.roi_last[0], center[1] - self.roi_last[1])
+        self.roi_last = center
+
+        dx, dy = self.roi_motion
+        mx = self.roi_margin + abs(dx)
+        my = self.roi_margin + abs(dy)
+        height, width = self.img.shape[:2]
+        x0 = int(max(0, x + dx - mx))
+        y0 = int(max(0, y + dy - my))
+        x1 = int(min(width, x + dx + w + mx))
+        y1 = int(min(height, y + dy + h + my))
+        self.roi = (x0, y0, x1, y1) if x1 > x0 and y1 > y0 else None
+
+    def region_contours(self, region):
+        # Full resolution contours of region, or of the whole frame for None
+        img, offset = self.img, (0, 0)
+        if region:
+            x0, y0, x1, y1 = region
+            img, offset = self.img[y0:y1, x0:x1], (x0, y0)
+
+        self.blur_img, self.color_mask, self.color_img, self.filtered_img = self.preprocess(img, self.buffers)
+        contours = self.get_contour(self.filtered_img, offset)
+        if region:
+            contours = self.clip_region(contours, region)
+        return contours
 
-        self.f_matches = self.area_filter(self.matches)
-        self.f_matches = self.perimeter_filter(self.f_matches)
+    def pyramid_contours(self, level):
+        # Find candidates on a downscaled frame, then only look at their
+        # neighbourhoods at full resolution for exact contours
+        scale = 1 / 2**level
+        height, width = self.img.shape[:2]
+        # Same rounding as resize uses for dsize from fx and fy
+        small = self.buffers.get("pyramid", (round(height * scale), round(width * scale)) + self.img.shape[2:])
+        small = cv2.resize(self.img, None, dst=small, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        _, _, _, filtered = self.preprocess(small, self.buffers)
+        candidates = self.get_matches(self.get_contour(filtered), self.t_contours, scale=scale)
+        if not candidates:
+            return []
+
+        m = self.pyramid_margin + 2**level
+        regions = list()
+        for p, c, d, a, l in candidates:
+            x, y, w, h = cv2.boundingRect(c)
+            regions.append([max(0, int(x / scale) - m), max(0, int(y / scale) - m),
+                            min(width, int((x + w) / scale) + m), min(height, int((y + h) / scale) + m)])
+
+        contours = list()
+        for region in merge_regions(regions):
+            contours.extend(self.region_contours(tuple(region)))
+        return contours
 
-        return self.f_matches
+    def clip_region(self, contours, region):
+        # Contours cut by the window edge are not the real shape, drop them.
+        # Edges that are also frame edges cut nothing.
+        if not len(contours):
+            return contours
+        x0, y0, x1, y1 = region
+        height, width = self.img.shape[:2]
+        bx, by, bw, bh = ContourBatch(contours).bbox.T
+        cut = np.zeros(len(contours), bool)
+        if x0 > 0:
+            cut |= bx <= x0
+        if y0 > 0:
+            cut |= by <= y0
+        if x1 < width:
+            cut |= bx + bw >= x1
+        if y1 < height:
+            cut |= by + bh >= y1
+        return [c for c, drop in zip(contours, cut.tolist()) if not drop]
+
+    def preprocess(self, img, buffers=None):
+        # With buffers the results are only valid until the next frame, the
+        # template state is preprocessed without so it keeps its own arrays
+        t = time.perf_counter()
+        blur_img = self.blur(img, buffers)
+        t = self.add_time("blur", t)
+        if buffers and self.app.state != "setup" and self.template.config["BinaryMethod"] in (0, 1):
+            # Only setup shows the masked color image, tracking goes straight to binary
+            if self.template.config["ColorSpace"] == 1:
+                # Color and binary are one lookup, timed as binary
+                color_mask, color_img = None, None
+                t = self.add_time("color", t)
+                filtered_img = self.hsv_band_lookup(blur_img, buffers)
+            else:
+                color_mask, color_img = self.range_mask(blur_img, buffers), None
+                t = self.add_time("color", t)
+                filtered_img = self.band_lookup(blur_img, color_mask, buffers)
+        else:
+            color_mask, color_img = self.color(blur_img, buffers)
+            t = self.add_time("color", t)
+            filtered_img = self.binary(color_img, buffers)
+        self.add_time("binary", t)
+
+        return blur_img, color_mask, color_img, filtered_img
+
+    def add_time(self, stage, start):
+        # Stages can run several times a frame (pyramid, regions), sum them up
+        now = time.perf_counter()
+        self.stage_times[stage] = self.stage_times.get(stage, 0.0) + now - start
+        return now
 
     #---------------------------------------------------------------------------
     # Filters
@@ -277,80 +1062,145 @@ class TemplateTracker:
 
         return contours
 
-    def binary_band_inv(self, img):
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _,img = cv2.threshold(img, self.template.config["BinaryUpper"],255, cv2.THRESH_TOZERO_INV)
-        _,img = cv2.threshold(img, self.template.config["BinaryLower"],255, cv2.THRESH_BINARY_INV)
+    def binary(self, img, buffers=None):
+        if self.template.config["BinaryMethod"] == 0:
+            return self.binary_band(img, buffers)
+        elif self.template.config["BinaryMethod"] == 1:
+            return self.binary_band_inv(img, buffers)
+        elif self.template.config["BinaryMethod"] == 2:
+            edges = buffers.get("binary", img.shape[:2]) if buffers else None
+            return cv2.Canny(img, self.template.config["BinaryLower"],self.template.config["BinaryUpper"], edges=edges)
+
+    def binary_band_inv(self, img, buffers=None):
+        gray = buffers.get("binary", img.shape[:2]) if buffers else None
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        _,img = cv2.threshold(img, self.template.config["BinaryUpper"],255, cv2.THRESH_TOZERO_INV, dst=img)
+        _,img = cv2.threshold(img, self.template.config["BinaryLower"],255, cv2.THRESH_BINARY_INV, dst=img)
         return img
 
-    def binary_band(self,img):
-        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        _,img = cv2.threshold(img, self.template.config["BinaryUpper"],255, cv2.THRESH_TOZERO_INV)
-        _,img = cv2.threshold(img, self.template.config["BinaryLower"],255, cv2.THRESH_BINARY)
+    def binary_band(self, img, buffers=None):
+        gray = buffers.get("binary", img.shape[:2]) if buffers else None
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=gray)
+        _,img = cv2.threshold(img, self.template.config["BinaryUpper"],255, cv2.THRESH_TOZERO_INV, dst=img)
+        _,img = cv2.threshold(img, self.template.config["BinaryLower"],255, cv2.THRESH_BINARY, dst=img)
         return img
 
-    def blur(self,img):
+    def blur(self, img, buffers=None):
         blur_mode = self.template.config["Blur"]
         if blur_mode == 0:
             return img
+        dst = buffers.like("blur", img) if buffers else None
         if blur_mode == 1:
-            return cv2.GaussianBlur(img, (5,5), 0)
+            return cv2.GaussianBlur(img, (5,5), 0, dst=dst)
         if blur_mode == 2:
-            return cv2.medianBlur(img,5)
+            return cv2.medianBlur(img, 5, dst=dst)
         if blur_mode == 3:
-            return cv2.bilateralFilter(img,9,75,75)
-
-    def color(self, img):
-        mask = cv2.inRange(img, self.template.get_hsv_lower(), self.template.get_hsv_upper())
-        res = cv2.bitwise_and(img,img,mask=mask)
+            return cv2.bilateralFilter(img, 9, 75, 75, dst=dst)
+
+    def color(self, img, buffers=None):
+        if not buffers:
+            mask = self.range_mask(img)
+            res = cv2.bitwise_and(img,img,mask=mask)
+            return mask, res
+
+        mask = self.range_mask(img, buffers)
+        # A masked bitwise_and leaves the pixels outside the mask as they were
+        res = buffers.like("color", img)
+        res.fill(0)
+        res = cv2.bitwise_and(img, img, dst=res, mask=mask)
         return mask, res
 
 
-    def area_filter(self, matches):
-        if not matches:
-            return
-        if self.template.config["AreaFilter"] == 0:
-            return matches
-
-        f_matches = list()
-        for p, c, d, a, l in matches:
-            if self.template.area + self.template.config["AreaFilter"] > a > self.template.area - self.template.config["AreaFilter"]:
-                f_matches.append([p, c, d, a, l])
-
-        return f_matches
-
-    def perimeter_filter(self, matches):
-        if not matches:
-            return
-        if self.template.config["PerimeterFilter"] == 0:
-            return matches
-
-        f_matches = list()
-        for p, c, d, a, l in matches:
-            if self.template.perimeter + self.template.config["PerimeterFilter"] > l > self.template.perimeter - self.template.config["PerimeterFilter"]:
-                f_matches.append( [p,c,d,a,l] )
-
-        return f_matches
+    def range_mask(self, img, buffers=None):
+        lower, upper = self.template.get_hsv_lower(), self.template.get_hsv_upper()
+        mask = buffers.get("mask", img.shape[:2]) if buffers else None
+        if self.template.config["ColorSpace"] != 1:
+            return cv2.inRange(img, lower, upper, dst=mask)
+
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV_FULL, dst=buffers.like("hsv", img) if buffers else None)
+        if lower[0] <= upper[0]:
+            return cv2.inRange(hsv, lower, upper, dst=mask)
+        # Hue range wraps around red, at least lower or at most upper
+        mask = cv2.inRange(hsv, lower, (255,) + upper[1:], dst=mask)
+        high = cv2.inRange(hsv, (0,) + lower[1:], upper, dst=buffers.get("high", img.shape[:2]) if buffers else None)
+        return cv2.bitwise_or(mask, high, dst=mask)
+
+    def hsv_band_lookup(self, img, buffers):
+        # range_mask() and band_lookup() for real HSV as one lookup per pixel,
+        # the table is built by hsv_table when the config changes
+        key = self.template.get_hsv_lower() + self.template.get_hsv_upper()
+        table = self.band()
+        key += self.band_key
+        if key != self.hsv_key:
+            self.hsv_key, self.hsv_table = key, hsv_table(key[:3], key[3:6], table)
+
+        # The BGRA pixel read as little-endian uint32 is r<<16 | g<<8 | b,
+        # shifted right by 3 it is the table byte and b & 7 the bit in it.
+        # Indices are intp, np.take would convert anything else to a new array.
+        shape = img.shape[:2]
+        bgra = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA, dst=buffers.get("bgra", shape + (4,)))
+        pixels = bgra.view(np.uint32).reshape(shape)
+        index = np.right_shift(pixels, 3, out=buffers.get("index", shape, np.intp))
+        index &= 0x1FFFFF                   # drops alpha
+        binary = np.take(self.hsv_table, index, out=buffers.get("binary", shape), mode="clip")
+        bit = np.bitwise_and(pixels, 7, out=buffers.get("bit", shape))
+        np.right_shift(binary, bit, out=binary)
+        binary &= 1
+        return cv2.compare(binary, 0, cv2.CMP_NE, dst=binary)
+
+    def band(self):
+        # band_table for the current config, rebuilt when it changes
+        config = self.template.config
+        key = (config["BinaryMethod"], config["BinaryLower"], config["BinaryUpper"])
+        if key != self.band_key:
+            self.band_key, self.band_table = key, band_table(*key)
+        return self.band_table
+
+    def band_lookup(self, img, mask, buffers):
+        # color() and binary_band(_inv)() without the masked color image. A
+        # pixel inside the mask keeps its gray value, so both thresholds fold
+        # into one table on the gray frame; outside it the gray value was 0.
+        table = self.band()
+        binary = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY, dst=buffers.get("binary", img.shape[:2]))
+        binary = cv2.LUT(binary, table, dst=binary)
+        if table[0]:
+            outside = cv2.bitwise_not(mask, dst=buffers.get("outside", mask.shape))
+            return cv2.bitwise_or(binary, outside, dst=binary)
+        return cv2.bitwise_and(binary, mask, dst=binary)
 
     #---------------------------------------------------------------------------
     # Matching Tools
     #---------------------------------------------------------------------------
-    def get_contour(self, img):
-        contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    def get_contour(self, img, offset=(0, 0)):
+        # offset maps contours found in a cropped region back to frame coordinates
+        t = time.perf_counter()
+        contours, _ = cv2.findContours(img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+        self.add_time("contours", t)
 
         return contours
 
-    def get_matches(self, c_contours, t_contours):
+    def get_matches(self, c_contours, t_contours, filters=True, scale=1):
 
         matches = list()
+        if not len(c_contours):
+            return matches
+        if not t_contours:
+            return
 
-        for c in c_contours:
-            if t_contours:
-                distance = cv2.matchShapes(t_contours[0], c, cv2.CONTOURS_MATCH_I1,0)
-            else:
-                return
-            if distance < self.template.config["MaxDistance"]: #Schwellenwert
-                matches.append( (self.get_center(c), c, distance, cv2.contourArea(c), cv2.arcLength(c, True)) )
+        # Cheap filters first, shape distance only for the survivors
+        batch, found, distances = self.cascade.run(c_contours, self.template_cache.state,
+                                                   self.template.config, cv2.CONTOURS_MATCH_I1, filters, scale)
+        t = time.perf_counter()
+        times = self.cascade.times
+        self.stage_times["matching"] = self.stage_times.get("matching", 0.0) + times["distance"]
+        self.stage_times["filters"] = self.stage_times.get("filters", 0.0) + sum(times.values()) - times["distance"]
+
+        centers = batch.centers.tolist()
+        areas = batch.area.tolist()
+        perimeters = batch.perimeter.tolist()
+        for i, p, d, a, l in zip(found.tolist(), centers, distances.tolist(), areas, perimeters):
+            matches.append( (tuple(p), c_contours[i], d, a, l) )
+        self.add_time("results", t)
 
         return matches
 
@@ -380,60 +1230,80 @@ class TemplateTracker:
     def live_init(self):
         self.setup_trackbars()
 
+    def snapshot(self, view):
+        # render() view of the last frame as JPEG. Tracking keeps no masks
+        # and color images, so the frame is preprocessed again like in setup.
+        if self.img is None:
+            return None
+        state = self.template_cache.get(self.template)
+        blur_img, color_mask, color_img, filtered_img = self.preprocess(self.img)
+        if view == 0:
+            img = color_mask
+        elif view == 1:
+            img = color_img
+        elif view == 2:
+            img = filtered_img
+        else:
+            contours = self.get_contour(filtered_img)
+            matches = self.get_matches(contours, state.contours, filters=view != 3)
+            img = draw_matches(self.img.copy(), matches)
+        ok, jpeg = cv2.imencode(".jpg", img)
+        return jpeg.tobytes() if ok else None
+
     def draw_contour(self, candidates, img):
-        if not candidates:
-            return img
-        for p, c, d, a, l  in candidates:
-            cv2.circle(img, p, 7, (0,0,255), -1)
-            cv2.putText(img, str(a)+"|"+str(l), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
-            #cv2.putText(img, str(p[0])+"|"+str(p[1]), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
-            cv2.drawContours(img, c, -1, (0,255,0), 2)
+        return draw_matches(img, candidates)
 
-        return img
+    # Trackbar name and config key, the maximum is in Template.limits
+    trackbars = (("Blur", "Blur"), ("Binary Method", "BinaryMethod"),
+                 ("Binary Lower", "BinaryLower"), ("Binary Upper", "BinaryUpper"),
+                 ("Hue Lower", "HueLower"), ("Hue Upper", "HueUpper"),
+                 ("Saturation Lower", "SaturationLower"), ("Saturation Upper", "SaturationUpper"),
+                 ("Value Lower", "ValueLower"), ("Value Upper", "ValueUpper"),
+                 ("Color Space", "ColorSpace"), ("Max Distance", "MaxDistance"),
+                 ("Area", "AreaFilter"), ("Perimeter", "PerimeterFilter"))
 
     def setup_trackbars(self):
+        # Trackbars write the config when they move instead of being read every frame
         cv2.namedWindow("Template")
         cv2.namedWindow(self.window)
-        cv2.createTrackbar("View",self.window,4,4,nothing)
-        cv2.createTrackbar("Blur",self.window,self.template.config["Blur"],3,nothing)
-        cv2.createTrackbar("Binary Method", self.window, self.template.config["BinaryMethod"],2,nothing)
-        cv2.createTrackbar("Binary Lower",self.window,self.template.config["BinaryLower"],255,nothing)
-        cv2.createTrackbar("Binary Upper",self.window,self.template.config["BinaryUpper"],255,nothing)
-        cv2.createTrackbar("Hue Lower",self.window,self.template.config["HueLower"],255,nothing)
-        cv2.createTrackbar("Hue Upper",self.window,self.template.config["HueUpper"],255,nothing)
-        cv2.createTrackbar("Saturation Lower",self.window,self.template.config["SaturationLower"],255,nothing)
-        cv2.createTrackbar("Saturation Upper",self.window,self.template.config["SaturationUpper"],255,nothing)
-        cv2.createTrackbar("Value Lower", self.window,self.template.config["ValueLower"],255,nothing)
-        cv2.createTrackbar("Value Upper",self.window,self.template.config["ValueUpper"],255,nothing)
-        cv2.createTrackbar("Max Distance", self.window, self.template.config["MaxDistance"],100,nothing)
-        cv2.createTrackbar("Area", self.window, self.template.config["AreaFilter"],2000,nothing)
-        cv2.createTrackbar("Perimeter", self.window, self.template.config["PerimeterFilter"],2000,nothing)
-
-    def update_trackbars(self):
-        self.view = cv2.getTrackbarPos("View",self.window)
-        self.template.config["Blur"] = cv2.getTrackbarPos("Blur",self.window)
-        self.template.config["BinaryMethod"] = cv2.getTrackbarPos("Binary Method",self.window)
-        self.template.config["BinaryLower"] = cv2.getTrackbarPos("Binary Lower",self.window)
-        self.template.config["BinaryUpper"] = cv2.getTrackbarPos("Binary Upper",self.window)
-        self.template.config["HueLower"] = cv2.getTrackbarPos("Hue Lower",self.window)
-        self.template.config["HueUpper"] = cv2.getTrackbarPos("Hue Upper",self.window)
-        self.template.config["SaturationLower"] = cv2.getTrackbarPos("Saturation Lower",self.window)
-        self.template.config["SaturationUpper"] = cv2.getTrackbarPos("Saturation Upper",self.window)
-        self.template.config["ValueLower"] = cv2.getTrackbarPos("Value Lower",self.window)
-        self.template.config["ValueUpper"] = cv2.getTrackbarPos("Value Upper",self.window)
-        self.template.config["MaxDistance"] = cv2.getTrackbarPos("Max Distance",self.window)
-        self.template.config["AreaFilter"] = cv2.getTrackbarPos("Area", self.window)
-        self.template.config["PerimeterFilter"] = cv2.getTrackbarPos("Perimeter", self.window)
+        cv2.createTrackbar("View",self.window,self.view,4,self.set_view)
+        for name, key in self.trackbars:
+            cv2.createTrackbar(name, self.window, self.template.config[key], Template.limits[key][1],
+                               lambda value, key=key: self.trackbar_moved(key, value))
+
+    def trackbar_moved(self, key, value):
+        if not self.syncing:
+            self.template.set(key, value)
+
+    def sync_trackbars(self):
+        # After a change from elsewhere (tuning commands). A config file can
+        # still hold a value above the limit, the trackbar shows its end.
+        self.syncing = True
+        for name, key in self.trackbars:
+            cv2.setTrackbarPos(name, self.window, min(self.template.config[key], Template.limits[key][1]))
+        self.syncing = False
+
+    def set_view(self, view):
+        self.view = view
 
     def show(self):
-        img = self.img.copy()
+        if self.headless or self.img is None:
+            # Neither the copy nor waitKey's 5 ms
+            return
+        img = self.buffers.like("show", self.img)
+        np.copyto(img, self.img)
         img = self.draw_contour(self.f_matches, img)
         cv2.imshow("Camera Stream",img)
         cv2.waitKey(5)
 
 
     def render(self):
-        img = self.img.copy()
+        if self.img is None:
+            # No frame yet, the keys still end or abort the setup
+            self.key_events()
+            return
+        img = self.buffers.like("render", self.img)
+        np.copyto(img, self.img)
         if self.view == 0:
             cv2.imshow(self.window, self.mock_img)
             cv2.imshow("Template", self.t_color_mask)
@@ -453,9 +1323,9 @@ class TemplateTracker:
 
             t_img = self.template.img.copy()
             if self.t_contours:
-                p = self.get_center(self.t_contours[0])
+                p = self.template_cache.state.center
                 cv2.circle(t_img, p, 7, (0,0,255), -1)
-                cv2.putText(t_img, str(cv2.contourArea(self.t_contours[0]))+"|"+str(cv2.arcLength(self.t_contours[0],True)), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
+                cv2.putText(t_img, str(self.template.area)+"|"+str(self.template.perimeter), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
                 #cv2.putText(img, str(p[0])+"|"+str(p[1]), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
                 cv2.drawContours(t_img, self.t_contours[0], -1, (0,255,0), 2)
             cv2.imshow("Template", t_img)
@@ -466,9 +1336,9 @@ class TemplateTracker:
 
             t_img = self.template.img.copy()
             if self.t_contours:
-                p = self.get_center(self.t_contours[0])
+                p = self.template_cache.state.center
                 cv2.circle(t_img, p, 7, (0,0,255), -1)
-                cv2.putText(t_img, str(cv2.contourArea(self.t_contours[0]))+"|"+str(cv2.arcLength(self.t_contours[0],True)), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
+                cv2.putText(t_img, str(self.template.area)+"|"+str(self.template.perimeter), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
                 #cv2.putText(img, str(p[0])+"|"+str(p[1]), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
                 cv2.drawContours(t_img, self.t_contours[0], -1, (0,255,0), 2)
                 cv2.imshow("Template", t_img)
@@ -506,5 +1376,105 @@ def nothing(x):
     pass
 
 
+def draw_matches(img, candidates):
+    if not candidates:
+        return img
+    for p, c, d, a, l  in candidates:
+        cv2.circle(img, p, 7, (0,0,255), -1)
+        cv2.putText(img, str(a)+"|"+str(l), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
+        #cv2.putText(img, str(p[0])+"|"+str(p[1]), (p[0] -20, p[1] -20), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0,0,255), 2)
+        cv2.drawContours(img, c, -1, (0,255,0), 2)
+
+    return img
+
+
+def band_table(method, lower, upper):
+    # binary_band (method 0) or binary_band_inv (1) as a table over gray values
+    gray = np.arange(256)
+    gray[gray > upper] = 0                  # THRESH_TOZERO_INV at upper
+    above = gray > lower                    # THRESH_BINARY(_INV) at lower
+    if method == 1:
+        above = ~above
+    return np.where(above, 255, 0).astype(np.uint8)
+
+
+def hsv_table(lower, upper, band):
+    # Binary value of every BGR color, 2 MB packed: the band of its gray
+    # value inside the HSV ranges, of gray 0 outside like band_lookup. Hue
+    # is COLOR_BGR2HSV_FULL's 0-255 for the full circle like the sliders, a
+    # lower hue above the upper one wraps around red. One plane per red
+    # value, b runs fastest so the bits pack in hsv_band_lookup's order.
+    g, b = np.mgrid[0:256, 0:256].astype(np.uint8)
+    plane = np.dstack((b, g, g))
+    accept = np.empty((256, 256 * 256), np.uint8)
+    wrap = lower[0] > upper[0]
+    for r in range(256):
+        plane[:, :, 2] = r
+        hsv = cv2.cvtColor(plane, cv2.COLOR_BGR2HSV_FULL)
+        if wrap:
+            # Hue at least lower or at most upper
+            low = cv2.inRange(hsv, lower, (255,) + tuple(upper[1:]))
+            high = cv2.inRange(hsv, (0,) + tuple(lower[1:]), upper)
+            mask = cv2.bitwise_or(low, high)
+        else:
+            mask = cv2.inRange(hsv, lower, upper)
+        binary = cv2.LUT(cv2.cvtColor(plane, cv2.COLOR_BGR2GRAY), band)
+        accept[r] = np.where(mask > 0, binary, band[0]).ravel()
+    return np.packbits(accept.ravel() > 0, bitorder="little")
+
+
+def merge_regions(regions):
+    # Merge overlapping [x0, y0, x1, y1] boxes so no area is processed twice
+    merged = list()
+    for r in sorted(regions):
+        for m in merged:
+            if r[0] <= m[2] and m[0] <= r[2] and r[1] <= m[3] and m[1] <= r[3]:
+                m[0], m[1] = min(m[0], r[0]), min(m[1], r[1])
+                m[2], m[3] = max(m[2], r[2]), max(m[3], r[3])
+                break
+        else:
+            merged.append(list(r))
+
+    if len(merged) < len(regions):
+        # A grown box may now overlap one merged earlier
+        return merge_regions(merged)
+    return merged
+
+
+
+def read_settings(path="../settings.txt"):
+    settings = dict()
+    cast_int = ["port","threaded_capture","capture_buffers","inbox_size",
+                "roi_mode","roi_margin","roi_refresh","pyramid_margin",
+                "change_gate","gate_threshold","gate_refresh",
+                "track_objects","track_gate","track_max_misses","track_min_hits",
+                "pub_deadband","pub_top_k","source_loop","metrics","pin_workers","pipeline",
+                "headless","preview_port"]
+    # Several cameras are given as a list, see supervisor.py
+    cast_list = ["camera_number"]
+    cast_float = ["pub_max_rate","pub_heartbeat","source_fps","metrics_interval","restart_delay","preview_fps",
+                  "template_watch"]
+    with open(path,"r") as file:
+        for line in file:
+            if line[0] == "#" or line[0] == "":
+                continue
+            line = line.rstrip().split("=")
+            if line[0] in cast_list:
+                settings[line[0]] = [int(v) for v in line[1].split(",")]
+                if len(settings[line[0]]) == 1:
+                    settings[line[0]] = settings[line[0]][0]
+            elif line[0] in cast_int:
+                settings[line[0]] = int(line[1])
+            elif line[0] in cast_float:
+                settings[line[0]] = float(line[1])
+            else:
+                settings[line[0]] = line[1]
+    return settings
+
+
 if __name__ == "__main__":
-    App().main_loop()
+    if isinstance(read_settings()["camera_number"], list):
+        from supervisor import Supervisor
+        Supervisor().run()
+    else:
+        App().main_loop()
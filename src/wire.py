@@ -0,0 +1,56 @@
+import struct
+import zlib
+import numpy as np
+
+# Binary detection message:
+#   header  "VVD", version (u8), record count (u16), little endian
+#   records count x RECORD
+MAGIC   = b"VVD"
+VERSION = 1
+HEADER  = struct.Struct("<3sBH")
+RECORD  = np.dtype([
+    ("seq",       "<u4"),   # frame sequence number
+    ("time",      "<f8"),   # capture timestamp, seconds since the epoch
+    ("template",  "<u4"),   # template_id() of the template name
+    ("x",         "<f4"),
+    ("y",         "<f4"),
+    ("distance",  "<f4"),
+    ("area",      "<f4"),
+    ("perimeter", "<f4"),
+    ])
+
+
+def template_id(name):
+    # Stable id from the template file name, independent of the directory
+    return zlib.crc32(str(name).replace("\\", "/").split("/")[-1].encode())
+
+
+def encode(matches, seq=0, timestamp=0.0, template=0):
+    # matches as returned by TemplateTracker.update: (position, contour, distance, area, perimeter)
+    matches = matches or []
+    records = np.zeros(len(matches), RECORD)
+    if matches:
+        records["seq"] = seq
+        records["time"] = timestamp
+        records["template"] = template
+        records["x"] = [m[0][0] for m in matches]
+        records["y"] = [m[0][1] for m in matches]
+        records["distance"] = [m[2] for m in matches]
+        records["area"] = [m[3] for m in matches]
+        records["perimeter"] = [m[4] for m in matches]
+    return HEADER.pack(MAGIC, VERSION, len(records)) + records.tobytes()
+
+
+def is_detection(payload):
+    return len(payload) >= HEADER.size and bytes(payload[:3]) == MAGIC
+
+
+def decode(payload):
+    if not is_detection(payload):
+        raise ValueError("Not a detection message")
+    magic, version, count = HEADER.unpack_from(payload)
+    if version != VERSION:
+        raise ValueError("Unsupported detection message version: " + str(version))
+    if len(payload) != HEADER.size + count * RECORD.itemsize:
+        raise ValueError("Truncated detection message")
+    return np.frombuffer(payload, RECORD, count, HEADER.size)